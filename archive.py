@@ -0,0 +1,169 @@
+"""
+Content-addressed archive of fetched portal pages.
+
+    python archive.py list [--since 2025-08-01] [--until 2025-08-31] [--key J1404-06-02]
+    python archive.py show <hash-prefix> > page.html
+
+Each distinct body is stored once (sha256 of the raw bytes), lzma
+compressed, in its own SQLite file (ARCHIVE_PATH) so the bot DB stays
+small. `fetches` records when a body was first seen for a URL and which
+announce key it parsed to. All writes run on a dedicated thread.
+"""
+import argparse
+import asyncio
+import lzma
+import logging
+import sqlite3
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from config import ARCHIVE_PATH, ARCHIVE_LZMA_PRESET
+
+log = logging.getLogger("archive")
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+_con: Optional[sqlite3.Connection] = None
+
+
+def _connect() -> sqlite3.Connection:
+    global _con
+    if _con is None:
+        _con = sqlite3.connect(ARCHIVE_PATH, check_same_thread=False)
+        _con.execute("PRAGMA journal_mode=WAL;")
+        _con.execute("PRAGMA synchronous=NORMAL;")
+        _con.execute("""
+        CREATE TABLE IF NOT EXISTS blobs(
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        ) WITHOUT ROWID;
+        """)
+        _con.execute("""
+        CREATE TABLE IF NOT EXISTS fetches(
+            fetched_at INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            ann_key TEXT
+        );
+        """)
+        _con.execute("CREATE INDEX IF NOT EXISTS idx_fetches_at ON fetches(fetched_at);")
+        _con.execute("CREATE INDEX IF NOT EXISTS idx_fetches_key ON fetches(ann_key);")
+        _con.commit()
+    return _con
+
+
+def _store(url: str, body_hash: str, body: bytes, fetched_at: int):
+    con = _connect()
+    if con.execute("SELECT 1 FROM blobs WHERE hash=?", (body_hash,)).fetchone() is None:
+        data = lzma.compress(body, preset=ARCHIVE_LZMA_PRESET)
+        con.execute("INSERT INTO blobs(hash, size, data) VALUES(?,?,?)", (body_hash, len(body), data))
+        log.debug("archived | hash=%s size=%s stored=%s", body_hash[:12], len(body), len(data))
+    con.execute("INSERT INTO fetches(fetched_at, url, hash) VALUES(?,?,?)", (fetched_at, url, body_hash))
+    con.commit()
+
+
+def _tag(url: str, body_hash: str, ann_key: str):
+    con = _connect()
+    con.execute("""
+        UPDATE fetches SET ann_key=? WHERE rowid=(
+            SELECT rowid FROM fetches WHERE url=? AND hash=? ORDER BY fetched_at DESC LIMIT 1
+        )
+    """, (ann_key, url, body_hash))
+    con.commit()
+
+
+def _log_failure(fut: Future):
+    if fut.exception() is not None:
+        log.warning("archive write failed: %s", fut.exception())
+
+
+def store(url: str, body_hash: str, body: bytes):
+    """Queue a fetched body for archiving; returns immediately."""
+    if not ARCHIVE_PATH:
+        return
+    _executor.submit(_store, url, body_hash, body, int(time.time())).add_done_callback(_log_failure)
+
+
+def tag(url: str, body_hash: Optional[str], ann_key: Optional[str]):
+    """Attach the parsed announce key to the latest fetch of this body."""
+    if not ARCHIVE_PATH or not body_hash or not ann_key:
+        return
+    _executor.submit(_tag, url, body_hash, ann_key).add_done_callback(_log_failure)
+
+
+# ---- lookups ----
+def list_fetches(since: int = 0, until: Optional[int] = None, ann_key: Optional[str] = None,
+                 url: Optional[str] = None) -> List[Tuple[int, str, str, Optional[str], int]]:
+    """(fetched_at, url, hash, ann_key, size) in time order; uses the fetched_at / ann_key index."""
+    sql = ["SELECT f.fetched_at, f.url, f.hash, f.ann_key, b.size FROM fetches f JOIN blobs b ON b.hash=f.hash"]
+    where, args = ["f.fetched_at >= ?"], [since]
+    if until is not None:
+        where.append("f.fetched_at < ?")
+        args.append(until)
+    if ann_key:
+        where.append("f.ann_key = ?")
+        args.append(ann_key)
+    if url:
+        where.append("f.url = ?")
+        args.append(url)
+    sql.append("WHERE " + " AND ".join(where) + " ORDER BY f.fetched_at")
+    return _connect().execute(" ".join(sql), args).fetchall()
+
+
+def get_body(hash_prefix: str) -> Optional[bytes]:
+    row = _connect().execute(
+        "SELECT data FROM blobs WHERE hash >= ? AND hash < ? LIMIT 1", (hash_prefix, hash_prefix + "g")
+    ).fetchone()
+    return lzma.decompress(row[0]) if row else None
+
+
+async def alist_fetches(*args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: list_fetches(*args, **kwargs))
+
+
+async def aget_body(hash_prefix: str) -> Optional[bytes]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, get_body, hash_prefix)
+
+
+def close():
+    """Wait for queued writes, then close the archive DB."""
+    def op():
+        global _con
+        if _con is not None:
+            _con.close()
+            _con = None
+    _executor.submit(op).result()
+
+
+def _ts(day: Optional[str]) -> Optional[int]:
+    return int(datetime.strptime(day, "%Y-%m-%d").timestamp()) if day else None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ls = sub.add_parser("list", help="fetches in a time range")
+    ls.add_argument("--since", help="YYYY-MM-DD")
+    ls.add_argument("--until", help="YYYY-MM-DD (exclusive)")
+    ls.add_argument("--key", help="announce key, e.g. J1404-06-02")
+    show = sub.add_parser("show", help="write an archived body to stdout")
+    show.add_argument("hash")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "list":
+        for at, url, h, key, size in list_fetches(_ts(args.since) or 0, _ts(args.until), args.key):
+            print(f"{datetime.fromtimestamp(at):%Y-%m-%d %H:%M:%S}  {h[:16]}  {size:>8}  {key or '-':<12}  {url}")
+    else:
+        body = get_body(args.hash)
+        if body is None:
+            sys.exit(f"no archived body with hash {args.hash}")
+        sys.stdout.buffer.write(body)
+
+
+if __name__ == "__main__":
+    main()
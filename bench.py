@@ -0,0 +1,257 @@
+"""
+Benchmarks for the crawl -> match -> render -> send pipeline.
+
+    python bench.py                         # default sizes
+    python bench.py --sections 20,200,2000 --chats 2000 --keywords 5
+
+Pages and subscriptions are synthetic but use the portal's markup
+(AnnTitle date, AnnDescription p/li lines, Persian digits, emoji
+decorations). Each run is written to BENCH_DIR as JSON and compared with
+the previous run so regressions show up as a percentage.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Optional
+
+# keep the benchmark away from the real database, even if DB_PATH is exported
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="qom-bench-"), "bench.db")
+
+import crawler  # noqa: E402
+import db  # noqa: E402
+from matcher import SubscriptionRegistry  # noqa: E402
+from notifier import (  # noqa: E402
+    RenderCache,
+    build_message,
+    match_sections,
+    send_long_message,
+    send_matching_sections,
+    sort_sections,
+)
+
+BENCH_DIR = os.getenv("BENCH_DIR", "bench")
+
+_FA_DIGITS = str.maketrans("0123456789", "۰۱۲۳۴۵۶۷۸۹")
+_STREETS = ["صفاییه", "امام", "زنبیل‌آباد", "پردیسان", "نیروگاه", "شهرک قدس", "جمهوری",
+            "عمار یاسر", "سالاریه", "بلوار امین", "توحید", "باجک", "۴۵ متری", "شاه ابراهیم"]
+_DECOR = ["❌ ", "🔻 ", "⚡️ ", "• ", "", "▶️ "]
+
+
+def _fa(n: int) -> str:
+    return str(n).translate(_FA_DIGITS)
+
+
+def street_vocab(size: int = 400):
+    return [f"{s} کوچه {_fa(i)}" for i in range(size // len(_STREETS) + 1) for s in _STREETS][:size]
+
+
+def make_page(n_sections: int, seed: int = 0, day: Optional[int] = None) -> str:
+    """`day` (1-31) sets a distinct announce date, i.e. a new update key."""
+    r = random.Random(seed)
+    vocab = street_vocab()
+    body = []
+    for i in range(n_sections):
+        h = r.randint(0, 21)
+        body.append(
+            f"<p>{r.choice(_DECOR)}<strong>قطعی برق</strong> ساعت {_fa(h)} تا {_fa(h + 2)} "
+            f"امور برق ناحیه {_fa(i % 4 + 1)}</p>"
+        )
+        for _ in range(r.randint(1, 5)):
+            streets = "، ".join(r.sample(vocab, 3))
+            body.append(f"<p>{r.choice(_DECOR)}{streets}&nbsp;و فرعی‌ها 🔌</p>")
+        if r.random() < 0.3:
+            body.append(f"<ul><li>• {r.choice(vocab)}</li></ul>")
+    return (
+        '<html><head><meta charset="utf-8"></head><body>'
+        '<div id="LastUpdatePortalCtrl">آخرین بروزرسانی : 1404/06/02 12:54</div>'
+        f'<span class="ItemTitle AnnTitle">برنامه خاموشی مورخ {"دوم" if day is None else _fa(day)} شهریور ماه ۱۴۰۴</span>'
+        f'<div class="dp-module-content"><div class="AnnDescription">{"".join(body)}</div></div>'
+        "</body></html>"
+    )
+
+
+def make_subscriptions(n_chats: int, per_chat: int, seed: int = 0):
+    r = random.Random(seed)
+    vocab = street_vocab()
+    return [(-100_000 - c, kw) for c in range(n_chats) for kw in r.sample(vocab, per_chat)]
+
+
+class FakeClient:
+    """Stands in for TelegramClient.send_message; records instead of sending."""
+
+    def __init__(self):
+        self.sent = 0
+        self.chars = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.sent += 1
+        self.chars += len(text)
+
+
+def _timeit(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - t0)
+    return result, samples
+
+
+async def _atimeit(fn, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = await fn()
+        samples.append(time.perf_counter() - t0)
+    return result, samples
+
+
+def _summary(samples):
+    return {
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "min_ms": round(min(samples) * 1000, 3),
+        "runs": len(samples),
+    }
+
+
+async def run_case(n_sections: int, n_chats: int, per_chat: int, repeat: int):
+    out = {}
+    html = make_page(n_sections)
+    out["page_bytes"] = len(html.encode())
+
+    # parsers alone (page -> lines); split_sections is timed separately below
+    parsed, t = _timeit(lambda: crawler._parse_lxml(html), repeat)
+    out["parse_lxml"] = _summary(t)
+    _, t = _timeit(lambda: crawler._parse_bs4(html), repeat)
+    out["parse_bs4"] = _summary(t)
+    _, t = _timeit(lambda: crawler.parse_page(html), repeat)
+    out["parse_page"] = _summary(t)
+
+    lines = parsed[1]
+    sections, t = _timeit(lambda: crawler.split_sections(lines), repeat)
+    out["split_sections"] = _summary(t)
+
+    subs = make_subscriptions(n_chats, per_chat)
+    reg = SubscriptionRegistry()
+    for chat_id, kw in subs:
+        reg.add(chat_id, kw)
+    _, t = _timeit(reg._ensure_automaton, 1)
+    out["automaton_build"] = _summary(t)
+    hits, t = _timeit(lambda: reg.match_sections(sections), repeat)
+    out["match_registry"] = _summary(t)
+    out["matched_chats"] = len(hits)
+
+    by_chat = {}
+    for chat_id, kw in subs:
+        by_chat.setdefault(chat_id, []).append(kw)
+    sample_chats = list(by_chat.items())[: min(200, len(by_chat))]
+    _, t = _timeit(lambda: [match_sections(sections, kws) for _c, kws in sample_chats], repeat)
+    out["match_per_chat_scan_200chats"] = _summary(t)
+
+    _, t = _timeit(lambda: sort_sections(sections), repeat)
+    out["sort_sections"] = _summary(t)
+
+    blocks = [
+        (sections[idx].hash, sections[idx].hour_range, kws, sections[idx].title, sections[idx].body)
+        for chat_hits in hits.values() for idx, kws in chat_hits
+    ][: max(1, n_sections)]
+    message, t = _timeit(lambda: build_message(blocks, "2 شهریور 1404"), repeat)
+    out["build_message"] = _summary(t)
+    out["message_chars"] = len(message)
+
+    fake = FakeClient()
+    _, t = await _atimeit(lambda: send_long_message(fake, 1, message), repeat)
+    out["send_long_message"] = _summary(t)
+
+    async def fanout():
+        client = FakeClient()
+        for chat_id, chat_hits in hits.items():
+            await send_matching_sections(client, chat_id, "bench", "bench", sections, [],
+                                         matches=chat_hits, force_send=True)
+        return client
+
+    client, t = await _atimeit(fanout, 1)
+    out["fanout_all_chats"] = _summary(t)
+    out["fanout_messages"] = client.sent
+
+    async def fanout_cached():
+        client = FakeClient()
+        cache = RenderCache()
+        for chat_id, chat_hits in hits.items():
+            await send_matching_sections(client, chat_id, "bench", "bench", sections, [],
+                                         matches=chat_hits, force_send=True, cache=cache)
+        return client
+
+    _, t = await _atimeit(fanout_cached, 1)
+    out["fanout_all_chats_render_cache"] = _summary(t)
+    return out
+
+
+def _previous_run():
+    files = sorted(glob.glob(os.path.join(BENCH_DIR, "bench-*.json")))
+    if not files:
+        return None
+    with open(files[-1], encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _compare(prev, cur):
+    for case, stages in cur["cases"].items():
+        old = prev.get("cases", {}).get(case, {})
+        for stage, val in stages.items():
+            if not isinstance(val, dict) or stage not in old:
+                continue
+            a, b = old[stage]["median_ms"], val["median_ms"]
+            if a:
+                print(f"  {case:<28} {stage:<30} {a:>10.3f} -> {b:>10.3f} ms ({(b - a) / a * 100:+.1f}%)")
+
+
+async def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sections", default="20,200,2000", help="comma-separated section counts")
+    ap.add_argument("--chats", type=int, default=1000)
+    ap.add_argument("--keywords", type=int, default=5, help="keywords per chat")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--no-save", action="store_true")
+    args = ap.parse_args(argv)
+
+    await db.init()
+    run = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "chats": args.chats,
+        "keywords_per_chat": args.keywords,
+        "cases": {},
+    }
+    for n in (int(x) for x in args.sections.split(",") if x.strip()):
+        case = f"sections={n}"
+        print(f"running {case} chats={args.chats}x{args.keywords} ...")
+        run["cases"][case] = await run_case(n, args.chats, args.keywords, args.repeat)
+        for stage, val in run["cases"][case].items():
+            if isinstance(val, dict):
+                print(f"  {stage:<30} {val['median_ms']:>10.3f} ms")
+    await db.close()
+
+    prev = _previous_run()
+    if prev:
+        print(f"compared with {prev['started']}:")
+        _compare(prev, run)
+    if not args.no_save:
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        path = os.path.join(BENCH_DIR, f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(run, f, ensure_ascii=False, indent=2)
+        print(f"saved -> {path}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
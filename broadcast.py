@@ -0,0 +1,163 @@
+import asyncio
+import functools
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import db
+from config import BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_SEC
+from dispatcher import dispatcher
+from notifier import send_part, split_message
+
+log = logging.getLogger("broadcast")
+
+# behind every outage alert in the dispatcher queue (alerts use 0..99)
+PRIORITY = 1000
+
+STATE_LABELS = {
+    "running": "در حال ارسال",
+    "cancelled": "لغو شد",
+    "done": "پایان یافت",
+}
+
+
+class _Job:
+    __slots__ = ("id", "text", "parts", "parts_sent", "cancelled", "task")
+
+    def __init__(self, broadcast_id: int, text: str):
+        self.id = broadcast_id
+        self.text = text
+        self.parts: List[str] = split_message(text)
+        # chat -> parts already delivered, so a FloodWait requeue resumes instead of repeating them
+        self.parts_sent: Dict[int, int] = {}
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+
+
+class BroadcastEngine:
+    """
+    Admin broadcasts as background jobs. Targets and per-chat results are
+    stored in the DB, sends go through the dispatcher (rate limiter and
+    FloodWait rescheduling) with at most `concurrency` chats in flight, and
+    the admin's progress message is edited every `progress_every` seconds.
+    A job interrupted by a restart, or cancelled, continues with its
+    pending chats on resume().
+    """
+
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY,
+                 progress_every: float = BROADCAST_PROGRESS_SEC):
+        self.concurrency = concurrency
+        self.progress_every = progress_every
+        self._jobs: Dict[int, _Job] = {}
+
+    async def start(self, client, admin_chat: int, text: str, chat_ids: Iterable[int]) -> int:
+        bid = await db.broadcast_create(text, admin_chat, chat_ids)
+        msg = await client.send_message(admin_chat, await self.progress_text(bid))
+        await db.broadcast_set_progress_msg(bid, msg.id)
+        self._spawn(client, bid, text)
+        log.info("broadcast started | id=%s", bid)
+        return bid
+
+    async def resume(self, client, broadcast_id: int) -> bool:
+        """Continue a cancelled or interrupted job with its pending chats."""
+        row = await db.broadcast_get(broadcast_id)
+        if row is None or broadcast_id in self._jobs or row[4] == "done":
+            return False
+        await db.broadcast_set_state(broadcast_id, "running")
+        self._spawn(client, broadcast_id, row[1])
+        log.info("broadcast resumed | id=%s", broadcast_id)
+        return True
+
+    async def resume_interrupted(self, client):
+        """Restart jobs that were still running when the bot stopped."""
+        for bid in await db.broadcast_ids("running"):
+            if bid not in self._jobs:
+                row = await db.broadcast_get(bid)
+                self._spawn(client, bid, row[1])
+                log.info("broadcast resumed after restart | id=%s", bid)
+
+    def cancel(self, broadcast_id: int) -> bool:
+        job = self._jobs.get(broadcast_id)
+        if job is None:
+            return False
+        # queued sends see the flag and skip; in-flight ones finish
+        job.cancelled = True
+        return True
+
+    def running(self):
+        return sorted(self._jobs)
+
+    def _spawn(self, client, broadcast_id: int, text: str):
+        job = _Job(broadcast_id, text)
+        self._jobs[broadcast_id] = job
+        job.task = asyncio.create_task(self._run(client, job))
+
+    async def _send_one(self, client, job: _Job, chat_id: int) -> bool:
+        if job.cancelled:
+            return False
+        for i in range(job.parts_sent.get(chat_id, 0), len(job.parts)):
+            await send_part(client, chat_id, job.parts[i], limiter=dispatcher.limiter)
+            job.parts_sent[chat_id] = i + 1
+        job.parts_sent.pop(chat_id, None)
+        return True
+
+    async def _deliver(self, client, job: _Job, chat_id: int, sem: asyncio.Semaphore):
+        try:
+            fut = dispatcher.submit(chat_id, functools.partial(self._send_one, client, job, chat_id),
+                                    priority=PRIORITY)
+            try:
+                if await fut:
+                    await db.broadcast_result(job.id, chat_id, "ok")
+            except Exception as e:
+                await db.broadcast_result(job.id, chat_id, "failed", f"{type(e).__name__}: {e}")
+        finally:
+            sem.release()
+
+    async def _run(self, client, job: _Job):
+        sem = asyncio.Semaphore(self.concurrency)
+        progress = asyncio.create_task(self._progress_loop(client, job.id))
+        tasks = []
+        try:
+            for chat_id in await db.broadcast_pending(job.id):
+                await sem.acquire()
+                if job.cancelled:
+                    sem.release()
+                    break
+                tasks.append(asyncio.create_task(self._deliver(client, job, chat_id, sem)))
+            await asyncio.gather(*tasks)
+            await db.broadcast_set_state(job.id, "cancelled" if job.cancelled else "done")
+            log.info("broadcast finished | id=%s cancelled=%s", job.id, job.cancelled)
+        except Exception as e:
+            log.exception("broadcast failed | id=%s: %s", job.id, e)
+        finally:
+            progress.cancel()
+            self._jobs.pop(job.id, None)
+            await self._edit_progress(client, job.id)
+
+    async def _progress_loop(self, client, broadcast_id: int):
+        while True:
+            await asyncio.sleep(self.progress_every)
+            await self._edit_progress(client, broadcast_id)
+
+    async def _edit_progress(self, client, broadcast_id: int):
+        try:
+            row = await db.broadcast_get(broadcast_id)
+            if row is None or not row[3]:
+                return
+            await client.edit_message(row[2], row[3], await self.progress_text(broadcast_id))
+        except Exception as e:
+            # MessageNotModifiedError when nothing changed since the last edit
+            log.debug("progress edit skipped | id=%s: %s", broadcast_id, e)
+
+    async def progress_text(self, broadcast_id: int) -> str:
+        row = await db.broadcast_get(broadcast_id)
+        counts = await db.broadcast_counts(broadcast_id)
+        total = sum(counts.values())
+        state = row[4] if row else "?"
+        return (
+            f"📣 ارسال همگانی #{broadcast_id} — {STATE_LABELS.get(state, state)}\n"
+            f"موفق: {counts.get('ok', 0)} | ناموفق: {counts.get('failed', 0)} | "
+            f"باقی‌مانده: {counts.get('pending', 0)} از {total}"
+        )
+
+
+engine = BroadcastEngine()
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+import db
+from config import CHAT_TITLE_TTL_HOURS, CHAT_TITLE_CONCURRENCY, CHAT_TITLE_REFRESH_MIN
+
+log = logging.getLogger("chattitles")
+
+# chats refreshed per background pass; the rest wait for the next one
+REFRESH_BATCH = 200
+# shown, and cached, when a chat's title can't be fetched
+UNKNOWN_TITLE = "?"
+
+
+def title_of(entity) -> str:
+    if getattr(entity, "title", None):
+        return entity.title
+    if getattr(entity, "first_name", None):
+        return entity.first_name
+    return UNKNOWN_TITLE
+
+
+async def resolve(client, chat_ids: Iterable[int], concurrency: int = CHAT_TITLE_CONCURRENCY) -> Dict[int, str]:
+    """Fetch titles with at most `concurrency` get_entity calls in flight and store them."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(chat_id: int) -> Optional[str]:
+        async with sem:
+            try:
+                return title_of(await client.get_entity(chat_id))
+            except Exception as e:
+                log.debug("title lookup failed | chat=%s: %s", chat_id, e)
+                return None
+
+    chat_ids = list(chat_ids)
+    titles = await asyncio.gather(*(one(c) for c in chat_ids))
+    found = {c: t for c, t in zip(chat_ids, titles) if t is not None}
+    # failures are stored too (as UNKNOWN_TITLE), so a chat the bot was removed
+    # from is looked up again after the TTL, not on every listing
+    await db.set_chat_titles([(c, t if t is not None else UNKNOWN_TITLE) for c, t in zip(chat_ids, titles)])
+    return found
+
+
+async def refresh_stale(client) -> int:
+    older_than = int(time.time() - CHAT_TITLE_TTL_HOURS * 3600)
+    stale = await db.stale_title_chats(older_than, REFRESH_BATCH)
+    if not stale:
+        return 0
+    found = await resolve(client, stale)
+    log.info("titles refreshed | stale=%s resolved=%s", len(stale), len(found))
+    return len(found)
+
+
+async def periodic_refresh(client):
+    while True:
+        try:
+            await refresh_stale(client)
+        except Exception as e:
+            log.exception("title refresh error: %s", e)
+        await asyncio.sleep(CHAT_TITLE_REFRESH_MIN * 60)
@@ -1,11 +1,18 @@
+import html
+import os
 import re
 import logging
 from datetime import datetime
 from telethon import events
-from config import ADMIN_USER_ID, DEFAULT_URL
+from config import ADMIN_USER_ID, ADMIN_LIST_PAGE_SIZE
 import db
-from crawler import crawl, page_signature
-from notifier import send_matching_sections, send_long_message
+from crawler import crawl_cached, page_signature, source_url
+from notifier import send_matching_sections, split_message
+from dispatcher import dispatcher
+from matcher import registry
+from broadcast import engine as broadcasts
+import chattitles
+import profiling
 
 log = logging.getLogger("commands")
 
@@ -25,24 +32,63 @@ ADMIN_HELP = (
     "دستورات مدیریت (فقط PV ادمین):\n"
     "• /admin — نمایش این راهنما\n"
     "• /stats — آمار کلی (آخرین کلید، تعداد گروه‌ها، تعداد ارسال‌ها)\n"
+    "• /profile_cycle [next] — پروفایل CPU یک دور آزمایشی (یا دور بعدی واقعی)\n"
+    "• /memtop [next] — پرمصرف‌ترین نقاط حافظه در یک دور آزمایشی (یا دور بعدی)\n"
     "• /lastupdate — نمایش آخرین کلید به‌روزرسانی ثبت‌شده\n"
-    "• /listchats — فهرست گروه‌های ثبت‌شده\n"
+    "• /listchats [صفحه] — فهرست گروه‌های ثبت‌شده\n"
+    "• /groups [صفحه] — فهرست نام گروه‌ها\n"
     "• /showchat <chat_id> — نمایش وضعیت یک گروه (کلیدواژه‌ها)\n"
     "• /listkw_chat <chat_id> — لیست کلیدواژه‌های یک گروه\n"
     "• /addkw_chat <chat_id> <kw> — افزودن کلیدواژه برای گروه\n"
     "• /delkw_chat <chat_id> <kw> — حذف کلیدواژه از گروه\n"
+    "• /setsource <chat_id> <url|default> — تعیین صفحه منبع (شرکت/ناحیه) برای گروه\n"
     "• /forcecrawl — مجبور کردن دور بعدی برای بررسی به عنوان به‌روزرسانی جدید\n"
     "• /dumpdb — دریافت فایل پایگاه داده (bot.db)\n"
+    "• /broadcast_all <متن> — ارسال پیام به همه گروه‌ها (در پس‌زمینه)\n"
+    "• /broadcast <id,id,...> <متن> — ارسال پیام به گروه‌های مشخص\n"
+    "• /broadcast_status [id] — وضعیت ارسال همگانی\n"
+    "• /broadcast_cancel <id> — لغو ارسال همگانی\n"
+    "• /broadcast_resume <id> — ادامه ارسال لغوشده/متوقف‌شده\n"
 )
 
 def is_admin(event) -> bool:
     return event.is_private and (event.sender_id == ADMIN_USER_ID)
 
+def _page(lines, page: int, command: str, per_page: int = ADMIN_LIST_PAGE_SIZE,
+          max_chars: int = 3500) -> str:
+    """One page of a long listing, with a pointer to the next page. A page holds
+    up to `per_page` lines and `max_chars` characters (Telegram caps a message at 4096)."""
+    pages, cur, size = [], [], 0
+    for line in lines:
+        if cur and (len(cur) >= per_page or size + len(line) + 1 > max_chars):
+            pages.append(cur)
+            cur, size = [], 0
+        cur.append(line)
+        size += len(line) + 1
+    pages.append(cur)
+    page = min(max(page, 1), len(pages))
+    out = pages[page - 1]
+    if len(pages) > 1:
+        nxt = f" — بعدی: {command} {page + 1}" if page < len(pages) else ""
+        out = out + ["", f"صفحه {page}/{len(pages)}{nxt}"]
+    return "\n".join(out)
+
+async def _titled_chats(client):
+    """(chat_id, title, created_at) from the DB cache; missing titles are resolved concurrently."""
+    rows = await db.list_chats_with_titles()
+    missing = [c for c, title, _created in rows if title is None]
+    found = await chattitles.resolve(client, missing) if missing else {}
+    return [(c, title or found.get(c, chattitles.UNKNOWN_TITLE), created) for c, title, created in rows]
+
 def register(client):
     @client.on(events.NewMessage(pattern=r"^/start"))
     async def start_handler(event):
         if event.is_group or event.is_channel:
-            db.upsert_chat(event.chat_id)
+            await db.upsert_chat(event.chat_id)
+            try:
+                await db.set_chat_titles([(event.chat_id, chattitles.title_of(await event.get_chat()))])
+            except Exception as e:
+                log.debug("title not stored | chat=%s: %s", event.chat_id, e)
             await event.reply("ربات برای این گروه فعال شد. برای راهنما: /help")
             log.info("group registered | chat=%s", event.chat_id)
 
@@ -56,15 +102,17 @@ def register(client):
         if not (event.is_group or event.is_channel):
             return
         kw = event.pattern_match.group(1).strip()
-        db.upsert_chat(event.chat_id)
-        ok = db.add_keyword(event.chat_id, kw)
+        await db.upsert_chat(event.chat_id)
+        ok = await db.add_keyword(event.chat_id, kw)
         if not ok:
             await event.reply("از قبل وجود دارد یا نامعتبر بود.")
             return
+        url = source_url(await db.get_chat_url(event.chat_id))
+        registry.add(event.chat_id, kw, url)
     
         # Added successfully — do an immediate one-off check for THIS kw only
         try:
-            last_update, sections, ann_display, ann_key = await crawl(DEFAULT_URL)
+            last_update, sections, ann_display, ann_key = await crawl_cached(url)
         except Exception as e:
             await event.reply("افزوده شد ✅\n(بررسی فوری ناموفق بود)")
             return
@@ -86,6 +134,7 @@ def register(client):
             keywords=[kw],
             force_send=True,
             ann_display=ann_display,
+            limiter=dispatcher.limiter,
         )
     
         if sent:
@@ -98,13 +147,15 @@ def register(client):
     async def delkw_handler(event):
         if not (event.is_group or event.is_channel): return
         kw = event.pattern_match.group(1).strip()
-        ok = db.del_keyword(event.chat_id, kw)
+        ok = await db.del_keyword(event.chat_id, kw)
+        if ok:
+            registry.remove(event.chat_id, kw)
         await event.reply("حذف شد ✅" if ok else "پیدا نشد.")
 
     @client.on(events.NewMessage(pattern=r"^/listkw$"))
     async def listkw_handler(event):
         if not (event.is_group or event.is_channel): return
-        kws = db.list_keywords(event.chat_id)
+        kws = await db.list_keywords(event.chat_id)
         if not kws:
             await event.reply("هنوز کلیدواژه‌ای ثبت نشده.")
         else:
@@ -115,12 +166,13 @@ def register(client):
         # anyone can use; send items regardless of previous sends
         if not (event.is_group or event.is_channel): return
         try:
-            kws = db.list_keywords(event.chat_id)
+            kws = await db.list_keywords(event.chat_id)
             if not kws:
                 await event.reply("کلیدواژه‌ای ثبت نشده."); return
 
             try:
-                last_update, sections, ann_display, ann_key = await crawl(DEFAULT_URL)
+                url = source_url(await db.get_chat_url(event.chat_id))
+                last_update, sections, ann_display, ann_key = await crawl_cached(url)
             except Exception as e:
                 await event.reply(f"خطا در دریافت داده: {e}")
                 log.exception("check: crawl failed | chat=%s", event.chat_id)
@@ -133,7 +185,8 @@ def register(client):
             last_display = last_update if last_update else "نامشخص (شناسه محتوا)"
 
             await send_matching_sections(client, event.chat_id, last_key, last_display, sections, kws,
-                                         force_send=True, ann_display=ann_display)
+                                         force_send=True, ann_display=ann_display,
+                                         limiter=dispatcher.limiter)
         except Exception as e:
             await event.reply(f"خطا: {e}")
             log.exception("check handler error | chat=%s", event.chat_id)
@@ -145,9 +198,9 @@ def register(client):
 
     @client.on(events.NewMessage(pattern=r"^/stats$", func=is_admin))
     async def admin_stats(event):
-        last = db.get_setting("last_update_seen") or "—"
-        chats = db.list_chats()
-        total_sent, per_chat = db.stats()
+        last = await db.get_setting("last_update_seen") or "—"
+        chats = await db.list_chats()
+        total_sent, per_chat = await db.stats()
         lines = [
             f"LastUpdateKey: {last}",
             f"Total chats: {len(chats)}",
@@ -156,52 +209,77 @@ def register(client):
         ] + [f"- {cid}: {cnt}" for cid, cnt in per_chat] or ["(none)"]
         await event.reply("\n".join(lines))
 
+    async def _run_profile(event, kind: str):
+        nxt = event.pattern_match.group(1) == "next"
+        try:
+            if nxt:
+                fut = profiling.request_next(kind)
+                await event.reply("Profiling the next crawl cycle…")
+                text, path = await fut
+            else:
+                await event.reply("Profiling a dry-run cycle (crawl + match + render, nothing sent)…")
+                _n, (text, path) = await profiling.profile(kind, profiling.dry_run_cycle)
+        except profiling.ProfilerBusy as e:
+            await event.reply(str(e)); return
+        except Exception as e:
+            log.exception("profile failed | kind=%s", kind)
+            await event.reply(f"Profile failed: {e}"); return
+        for chunk in split_message(text):
+            await event.reply(f"<pre>{html.escape(chunk)}</pre>", parse_mode="html")
+        await event.client.send_file(event.chat_id, path, caption=os.path.basename(path))
+
+    @client.on(events.NewMessage(pattern=r"^/profile_cycle(?:\s+(next))?$", func=is_admin))
+    async def admin_profile_cycle(event):
+        await _run_profile(event, "cpu")
+
+    @client.on(events.NewMessage(pattern=r"^/memtop(?:\s+(next))?$", func=is_admin))
+    async def admin_memtop(event):
+        await _run_profile(event, "mem")
+
     @client.on(events.NewMessage(pattern=r"^/lastupdate$", func=is_admin))
     async def admin_lastupdate(event):
-        await event.reply(f"LastUpdateKey: {db.get_setting('last_update_seen') or '—'}")
+        last = await db.get_setting("last_update_seen")
+        await event.reply(f"LastUpdateKey: {last or '—'}")
 
-    @client.on(events.NewMessage(pattern=r"^/listchats$", func=is_admin))
+    @client.on(events.NewMessage(pattern=r"^/listchats(?:\s+(\d+))?$", func=is_admin))
     async def admin_listchats(event):
-        chats = db.list_chats()
+        chats = await _titled_chats(event.client)
         if not chats:
             await event.reply("No chats registered."); return
         out = []
-        for chat_id, _url, created_at in chats:
+        for chat_id, chat_name, created_at in chats:
             dt = datetime.fromtimestamp(created_at).isoformat(sep=" ", timespec="seconds")
-            try:
-                entity = await client.get_entity(chat_id)
-                chat_name = entity.title if hasattr(entity, "title") else entity.first_name
-            except Exception:
-                chat_name = "?"
             out.append(f"{chat_name} ({chat_id}) | joined={dt}")
 
-        await event.reply("\n".join(out))
+        await event.reply(_page(out, int(event.pattern_match.group(1) or 1), "/listchats"))
 
     @client.on(events.NewMessage(pattern=r"^/showchat\s+(-?\d+)$", func=is_admin))
     async def admin_showchat(event):
         chat_id = int(event.pattern_match.group(1))
-        kws = db.list_keywords(chat_id)
+        kws = await db.list_keywords(chat_id)
         await event.reply(f"Chat: {chat_id}\nKeywords:\n- " + ("\n- ".join(kws) if kws else "(none)"))
 
     @client.on(events.NewMessage(pattern=r"^/listkw_chat\s+(-?\d+)$", func=is_admin))
     async def admin_listkw_chat(event):
         chat_id = int(event.pattern_match.group(1))
-        kws = db.list_keywords(chat_id)
+        kws = await db.list_keywords(chat_id)
         await event.reply("Keywords:\n- " + ("\n- ".join(kws) if kws else "(none)"))
 
     @client.on(events.NewMessage(pattern=r"^/addkw_chat\s+(-?\d+)\s+(.+)$", func=is_admin))
     async def admin_addkw_chat(event):
         chat_id = int(event.pattern_match.group(1))
         kw = event.pattern_match.group(2).strip()
-        db.upsert_chat(chat_id)
-        ok = db.add_keyword(chat_id, kw)
+        await db.upsert_chat(chat_id)
+        ok = await db.add_keyword(chat_id, kw)
         if not ok:
             await event.reply("Already exists or invalid.")
             return
+        url = source_url(await db.get_chat_url(chat_id))
+        registry.add(chat_id, kw, url)
 
         # Try immediate crawl for the newly added keyword
         try:
-            last_update, sections, ann_display, ann_key = await crawl(DEFAULT_URL)
+            last_update, sections, ann_display, ann_key = await crawl_cached(url)
         except Exception as e:
             await event.reply("Added ✅\n(Immediate check failed)")
             return
@@ -222,6 +300,7 @@ def register(client):
             keywords=[kw],
             force_send=True,
             ann_display=ann_display,
+            limiter=dispatcher.limiter,
         )
 
         if sent:
@@ -234,51 +313,53 @@ def register(client):
     async def admin_delkw_chat(event):
         chat_id = int(event.pattern_match.group(1))
         kw = event.pattern_match.group(2).strip()
-        ok = db.del_keyword(chat_id, kw)
+        ok = await db.del_keyword(chat_id, kw)
+        if ok:
+            registry.remove(chat_id, kw)
         await event.reply("Deleted ✅" if ok else "Not found.")
 
     @client.on(events.NewMessage(pattern=r"^/forcecrawl$", func=is_admin))
     async def admin_forcecrawl(event):
-        db.set_setting("last_update_seen", "")
+        await db.set_setting("last_update_seen", "")
+        for key, _value in await db.settings_with_prefix("last_update_seen:"):
+            await db.set_setting(key, "")
         await event.reply("Next cycle will treat as new update. ✅")
 
+    @client.on(events.NewMessage(pattern=r"^/setsource\s+(-?\d+)\s+(\S+)$", func=is_admin))
+    async def admin_setsource(event):
+        chat_id = int(event.pattern_match.group(1))
+        url = event.pattern_match.group(2).strip()
+        if url == "default":
+            url = ""
+        elif not re.match(r"^https?://", url):
+            await event.reply("URL must start with http:// or https:// (or use: default)")
+            return
+        if not await db.set_chat_url(chat_id, url):
+            await event.reply("Chat not registered.")
+            return
+        registry.set_source(chat_id, url)
+        await event.reply(f"Source for {chat_id}: {source_url(url)} ✅")
+
     @client.on(events.NewMessage(pattern=r"^/dumpdb$", func=is_admin))
     async def admin_dumpdb(event):
         from config import DB_PATH
         import os
+        await db.flush()
         if os.path.exists(DB_PATH):
             await event.client.send_file(event.chat_id, DB_PATH, caption="bot.db")
         else:
             await event.reply("DB file not found.")
 
-    # ---- helper: resolve chat title for pretty listing ----
-    async def _chat_title(client, chat_id: int) -> str:
-        try:
-            ent = await client.get_entity(chat_id)
-            if hasattr(ent, "title") and ent.title:
-                return ent.title
-            if hasattr(ent, "first_name") and ent.first_name:
-                return ent.first_name
-            return "?"
-        except Exception:
-            return "?"
-
     # ===== List groups =====
-    @client.on(events.NewMessage(pattern=r"^/groups$", func=is_admin))
+    @client.on(events.NewMessage(pattern=r"^/groups(?:\s+(\d+))?$", func=is_admin))
     async def admin_list_groups(event):
-        chats = db.list_chats()
+        chats = await _titled_chats(event.client)
         if not chats:
             await event.reply("هیچ گروهی ثبت نشده.")
             return
-        lines = []
-        for chat_id, _url, created_at in chats:
-            name = await _chat_title(event.client, chat_id)
-            lines.append(f"• {name} ({chat_id})")
-        # طول پیام را کنترل کنیم
-        text = "گروه‌های ثبت‌شده:\n" + "\n".join(lines)
-        if len(text) > 3500:
-            text = text[:3500] + "\n..."
-        await event.reply(text)
+        lines = [f"• {name} ({chat_id})" for chat_id, name, _created in chats]
+        page = _page(lines, int(event.pattern_match.group(1) or 1), "/groups")
+        await event.reply("گروه‌های ثبت‌شده:\n" + page)
 
     # ---- extract text: from inline args OR from replied message ----
     def _extract_broadcast_text(event, inline_text: str) -> str:
@@ -312,19 +393,13 @@ def register(client):
             await event.reply("متنی برای ارسال پیدا نشد. یا بعد از دستور بنویسید یا روی پیام ریپلای کنید.")
             return
 
-        chats = db.list_chats()
+        chats = await db.list_chats()
         if not chats:
             await event.reply("هیچ گروهی ثبت نشده.")
             return
 
-        ok, fail = 0, 0
-        for chat_id, _url, _created in chats:
-            try:
-                await send_long_message(event.client, chat_id, msg_text)
-                ok += 1
-            except Exception as e:
-                fail += 1
-        await event.reply(f"ارسال به همه انجام شد. موفق: {ok} | ناموفق: {fail}")
+        # runs in the background; progress is a separate message edited in place
+        await broadcasts.start(event.client, event.chat_id, msg_text, [c for c, _url, _created in chats])
 
     # ===== Broadcast to selected groups by IDs =====
     # شکل ۱: /broadcast -100123,-100456 سلام
@@ -352,13 +427,37 @@ def register(client):
             await event.reply("هیچ chat_id معتبری ارائه نشد.")
             return
 
-        ok, fail = 0, 0
-        for cid in ids:
-            try:
-                await send_long_message(event.client, cid, msg_text)
-                ok += 1
-            except Exception:
-                fail += 1
+        await broadcasts.start(event.client, event.chat_id, msg_text, ids)
+
+    @client.on(events.NewMessage(pattern=r"^/broadcast_status(?:\s+(\d+))?$", func=is_admin))
+    async def admin_broadcast_status(event):
+        if event.pattern_match.group(1):
+            bid = int(event.pattern_match.group(1))
+            if await db.broadcast_get(bid) is None:
+                await event.reply("Broadcast not found."); return
+            lines = [await broadcasts.progress_text(bid)]
+            failures = await db.broadcast_failures(bid)
+            if failures:
+                lines.append("ناموفق‌ها:")
+                lines += [f"- {cid}: {err}" for cid, err in failures]
+            await event.reply("\n".join(lines))
+            return
+        running = broadcasts.running()
+        interrupted = (await db.broadcast_ids("cancelled"))[-5:]
+        await event.reply(
+            f"Running: {', '.join(map(str, running)) or '—'}\n"
+            f"Cancelled (resumable): {', '.join(map(str, interrupted)) or '—'}"
+        )
 
-        await event.reply(f"ارسال انجام شد. موفق: {ok} | ناموفق: {fail}")
+    @client.on(events.NewMessage(pattern=r"^/broadcast_cancel\s+(\d+)$", func=is_admin))
+    async def admin_broadcast_cancel(event):
+        bid = int(event.pattern_match.group(1))
+        ok = broadcasts.cancel(bid)
+        await event.reply("Cancelling ✅ (pending chats can be resumed)" if ok else "No running broadcast with that id.")
+
+    @client.on(events.NewMessage(pattern=r"^/broadcast_resume\s+(\d+)$", func=is_admin))
+    async def admin_broadcast_resume(event):
+        bid = int(event.pattern_match.group(1))
+        ok = await broadcasts.resume(event.client, bid)
+        await event.reply("Resumed ✅" if ok else "Nothing to resume (unknown, running or finished).")
         
\ No newline at end of file
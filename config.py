@@ -9,15 +9,79 @@ BOT_TOKEN = os.getenv("BOT_TOKEN") or ""
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 DEFAULT_URL = os.getenv("DEFAULT_URL") or "https://qepd.co.ir/fa-IR/DouranPortal/6423/page/%D8%AE%D8%A7%D9%85%D9%88%D8%B4%DB%8C-%D9%87%D8%A7"
 CRAWL_INTERVAL_MIN = int(os.getenv("CRAWL_INTERVAL_MIN", "10"))
+# Adaptive crawl scheduling: hard bounds, history used for the change profile, +/- jitter fraction
+CRAWL_MIN_INTERVAL_SEC = int(os.getenv("CRAWL_MIN_INTERVAL_SEC", "60"))
+CRAWL_MAX_INTERVAL_SEC = int(os.getenv("CRAWL_MAX_INTERVAL_SEC", "1800"))
+SCHED_HISTORY_DAYS = int(os.getenv("SCHED_HISTORY_DAYS", "60"))
+SCHED_JITTER = float(os.getenv("SCHED_JITTER", "0.1"))
+# How many source pages (distinct chats.url) are crawled at once
+CRAWL_SOURCE_CONCURRENCY = int(os.getenv("CRAWL_SOURCE_CONCURRENCY", "4"))
+# /check, /addkw reuse a crawl snapshot up to this old (seconds)
+CRAWL_CACHE_TTL_SEC = int(os.getenv("CRAWL_CACHE_TTL_SEC", "60"))
+# Parse while downloading and stop once the announcement block is complete
+CRAWL_STREAMING = os.getenv("CRAWL_STREAMING", "0") == "1"
+
+# sent_sections retention: drop dedup rows of update keys older than this
+SENT_RETENTION_DAYS = int(os.getenv("SENT_RETENTION_DAYS", "30"))
+DB_PRUNE_BATCH = int(os.getenv("DB_PRUNE_BATCH", "500"))
+DB_MAINTENANCE_INTERVAL_MIN = int(os.getenv("DB_MAINTENANCE_INTERVAL_MIN", "60"))
+DB_VACUUM_PAGES = int(os.getenv("DB_VACUUM_PAGES", "1000"))
+
+# Notification fan-out (Telegram bot limits: ~30 msg/s overall, ~20 msg/min per group)
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "16"))
+DISPATCH_GLOBAL_RATE = float(os.getenv("DISPATCH_GLOBAL_RATE", "25"))
+DISPATCH_GLOBAL_BURST = int(os.getenv("DISPATCH_GLOBAL_BURST", "25"))
+DISPATCH_PER_CHAT_INTERVAL = float(os.getenv("DISPATCH_PER_CHAT_INTERVAL", "3"))
+DISPATCH_MAX_RETRIES = int(os.getenv("DISPATCH_MAX_RETRIES", "3"))
+# Durable outbox: rows claimed per poll, idle poll interval, retries with exponential backoff
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200"))
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SEC = float(os.getenv("OUTBOX_RETRY_BASE_SEC", "30"))
+OUTBOX_RETRY_MAX_SEC = float(os.getenv("OUTBOX_RETRY_MAX_SEC", "3600"))
+# Sharded fan-out: SHARD_WORKERS processes each match and deliver for the chats with
+# chat_id % SHARD_WORKERS == index; this process only crawls and publishes (0 = all in one process)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_POLL_SEC = float(os.getenv("SHARD_POLL_SEC", "1"))
+# Cached chat titles for /listchats and /groups
+CHAT_TITLE_TTL_HOURS = float(os.getenv("CHAT_TITLE_TTL_HOURS", "24"))
+CHAT_TITLE_CONCURRENCY = int(os.getenv("CHAT_TITLE_CONCURRENCY", "4"))
+CHAT_TITLE_REFRESH_MIN = int(os.getenv("CHAT_TITLE_REFRESH_MIN", "30"))
+ADMIN_LIST_PAGE_SIZE = int(os.getenv("ADMIN_LIST_PAGE_SIZE", "50"))
+# /profile_cycle and /memtop: where full stats files go, rows in the summary
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+# Admin broadcasts: chats sent to concurrently, progress message refresh interval
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_PROGRESS_SEC = float(os.getenv("BROADCAST_PROGRESS_SEC", "5"))
+# Per-cycle cache of rendered fragments/messages shared across chats (entries per kind)
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "2048"))
+
+# Prometheus metrics endpoint (METRICS_PORT=0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
 
 # Logging
 LOG_DIR = os.getenv("LOG_DIR", "logs")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", "5242880"))  # 5 MB
 LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json (one JSON object per line)
+# At most LOG_DEBUG_BURST debug lines per message per LOG_DEBUG_WINDOW_SEC (0 = no sampling)
+LOG_DEBUG_BURST = int(os.getenv("LOG_DEBUG_BURST", "20"))
+LOG_DEBUG_WINDOW_SEC = float(os.getenv("LOG_DEBUG_WINDOW_SEC", "10"))
 
 # Proxy (keep your working setup)
 PROXY = ("socks5", os.getenv("SOCKS_HOST", "127.0.0.1"), int(os.getenv("SOCKS_PORT", "10808")), True)
 
 DB_PATH = os.path.abspath(os.getenv("DB_PATH", "bot.db"))
+# Group commit: pending writes are committed after this many ms or this many writes
+DB_COMMIT_INTERVAL_MS = int(os.getenv("DB_COMMIT_INTERVAL_MS", "250"))
+DB_COMMIT_MAX_PENDING = int(os.getenv("DB_COMMIT_MAX_PENDING", "500"))
+# How long a write waits for another process's transaction (sharded mode) before failing
+DB_BUSY_TIMEOUT_SEC = float(os.getenv("DB_BUSY_TIMEOUT_SEC", "30"))
+# Archive of every distinct fetched page (separate SQLite file; empty disables)
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "archive.db")
+ARCHIVE_PATH = os.path.abspath(ARCHIVE_PATH) if ARCHIVE_PATH else ""
+ARCHIVE_LZMA_PRESET = int(os.getenv("ARCHIVE_LZMA_PRESET", "6"))
 LAST_UPDATE_SELECTOR_ID = "LastUpdatePortalCtrl"
@@ -2,46 +2,141 @@ import asyncio
 import hashlib
 import logging
 import re
-from typing import List, Optional, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import httpx
 from bs4 import BeautifulSoup
-from config import DEFAULT_URL, LAST_UPDATE_SELECTOR_ID
-from textutils import clean_text, strip_decor_prefix, extract_announce_date_key
+from lxml import etree, html as lxml_html
+import archive
+import metrics
+from config import DEFAULT_URL, LAST_UPDATE_SELECTOR_ID, CRAWL_CACHE_TTL_SEC, CRAWL_STREAMING
+from textutils import (
+    clean_text,
+    strip_decor_prefix,
+    extract_announce_date_key,
+    extract_hour_range_display,
+    normalize_for_match,
+    parse_start_hour_from_title,
+)
 
 log = logging.getLogger("crawler")
 
+def source_url(url: Optional[str]) -> str:
+    """A chat's crawl source; an empty chats.url means DEFAULT_URL."""
+    return url or DEFAULT_URL
+
 def is_section_start(line: str) -> bool:
     return ("ساعت" in line) and (("قطعی" in line) or ("برق" in line))
 
-async def fetch_html(url: str, timeout=30, retries=3, backoff=2.0) -> str:
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-            "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+    )
+}
+
+# One keep-alive client for the whole process (TCP+TLS set up once)
+_client: Optional[httpx.AsyncClient] = None
+
+
+class _PageState:
+    """Per-URL validators, raw body hash and the last parsed crawl result."""
+    __slots__ = ("etag", "last_modified", "body_hash", "result")
+
+    def __init__(self):
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.body_hash: Optional[str] = None
+        self.result = None
+
+
+_pages: Dict[str, _PageState] = {}
+
+
+def _conditional_headers(state: _PageState) -> Dict[str, str]:
+    headers = {}
+    if state.result is not None:
+        if state.etag:
+            headers["If-None-Match"] = state.etag
+        if state.last_modified:
+            headers["If-Modified-Since"] = state.last_modified
+    return headers
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers=_HEADERS,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
         )
-    }
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def fetch_html(url: str, timeout=30, retries=3, backoff=2.0) -> Optional[str]:
+    """
+    Conditional GET over the pooled client. Returns the page text, or None
+    when the page is unchanged since the last parsed crawl (304, or a body
+    byte-identical to the previous one).
+    """
+    state = _pages.setdefault(url, _PageState())
+    headers = _conditional_headers(state)
+
     last_err = None
     for attempt in range(1, retries + 1):
+        t0 = time.perf_counter()
         try:
-            async with httpx.AsyncClient(headers=headers, timeout=timeout, follow_redirects=True) as sess:
-                r = await sess.get(url)
-                r.raise_for_status()
-                r.encoding = r.encoding or "utf-8"
-                log.debug("fetch ok attempt=%s", attempt)
-                return r.text
+            r = await _get_client().get(url, headers=headers, timeout=timeout)
+            metrics.FETCH_SECONDS.observe(time.perf_counter() - t0)
+            if r.status_code == 304 and state.result is not None:
+                log.debug("fetch not modified attempt=%s", attempt)
+                metrics.FETCH_ATTEMPTS.inc(result="not_modified")
+                return None
+            r.raise_for_status()
+            state.etag = r.headers.get("ETag")
+            state.last_modified = r.headers.get("Last-Modified")
+            body_hash = hashlib.sha256(r.content).hexdigest()
+            if body_hash == state.body_hash and state.result is not None:
+                log.debug("fetch ok, body unchanged attempt=%s", attempt)
+                metrics.FETCH_ATTEMPTS.inc(result="unchanged")
+                return None
+            state.body_hash = body_hash
+            # new distinct body: compressed and stored on the archive thread
+            archive.store(url, body_hash, r.content)
+            r.encoding = r.encoding or "utf-8"
+            log.debug("fetch ok attempt=%s", attempt)
+            metrics.FETCH_ATTEMPTS.inc(result="ok")
+            return r.text
         except Exception as e:
+            metrics.FETCH_ATTEMPTS.inc(result="error")
             last_err = e
             log.warning("fetch failed attempt=%s err=%s", attempt, e)
             await asyncio.sleep(backoff * attempt)
     raise RuntimeError(f"fetch failed after {retries} retries: {last_err}")
 
+def _last_update_from_text(text: str) -> str:
+    text = clean_text(text)
+    m = re.search(r"[:：]\s*(\d{4}/\d{2}/\d{2}\s+\d{2}:\d{2})", text)
+    return m.group(1) if m else text
+
+def _line_from_text(txt: str) -> str:
+    txt = clean_text(txt)
+    return strip_decor_prefix(txt)   # drop leading ❌, 🔻, bullets, etc.
+
 def parse_last_update(soup: BeautifulSoup) -> Optional[str]:
     node = soup.find(id=LAST_UPDATE_SELECTOR_ID)
     if node:
-        text = clean_text(node.get_text(" ", strip=True))
-        m = re.search(r"[:：]\s*(\d{4}/\d{2}/\d{2}\s+\d{2}:\d{2})", text)
-        return m.group(1) if m else text
+        return _last_update_from_text(node.get_text(" ", strip=True))
     return None
 
 def parse_announce_date(soup: BeautifulSoup):
@@ -64,46 +159,318 @@ def extract_lines(soup: BeautifulSoup) -> List[str]:
     nodes = container.select("p, li")
     lines: List[str] = []
     for node in nodes:
-        txt = node.get_text(" ", strip=True)
-        txt = clean_text(txt)
-        txt = strip_decor_prefix(txt)   # drop leading ❌, 🔻, bullets, etc.
+        txt = _line_from_text(node.get_text(" ", strip=True))
         if txt:
             lines.append(txt)
     return lines
 
-def split_sections(lines: List[str]) -> List[Tuple[str, List[str]]]:
-    sections: List[Tuple[str, List[str]]] = []
+# ---- lxml fast path: same results as the BeautifulSoup functions above ----
+def _xp_class(*names: str) -> str:
+    return " and ".join(f"contains(concat(' ', normalize-space(@class), ' '), ' {n} ')" for n in names)
+
+_X_LAST_UPDATE = etree.XPath(f"//*[@id='{LAST_UPDATE_SELECTOR_ID}']")
+_X_ANN_TITLE = etree.XPath(f"//span[{_xp_class('ItemTitle', 'AnnTitle')}]")
+_X_ANN_DESC = etree.XPath(f"//div[{_xp_class('AnnDescription')}]")
+_X_MODULE = etree.XPath(f"//div[{_xp_class('dp-module-content')}]")
+_X_LINES = etree.XPath(".//p | .//li")
+
+# bs4's get_text() leaves out script/style strings and comments
+_NO_TEXT_TAGS = frozenset(("script", "style", "template"))
+
+def _lx_text(el) -> str:
+    """Equivalent of bs4 `get_text(" ", strip=True)` for an lxml element."""
+    parts: List[str] = []
+
+    def walk(node):
+        if not isinstance(node.tag, str) or node.tag in _NO_TEXT_TAGS:
+            return
+        if node.text:
+            parts.append(node.text)
+        for child in node:
+            walk(child)
+            if child.tail:
+                parts.append(child.tail)
+
+    walk(el)
+    return " ".join(t for t in (p.strip() for p in parts) if t)
+
+def _parse_lxml(html: str):
+    """Returns None when the page doesn't have the expected announcement markup."""
+    root = lxml_html.document_fromstring(html)
+    containers = _X_ANN_DESC(root) or _X_MODULE(root)
+    if not containers:
+        return None
+
+    nodes = _X_LAST_UPDATE(root)
+    last_update = _last_update_from_text(_lx_text(nodes[0])) if nodes else None
+
+    ann_display, ann_key = None, None
+    for el in _X_ANN_TITLE(root):
+        ann_display, ann_key = extract_announce_date_key(clean_text(_lx_text(el)))
+        if ann_key:
+            break
+
+    lines: List[str] = []
+    for node in _X_LINES(containers[0]):
+        txt = _line_from_text(_lx_text(node))
+        if txt:
+            lines.append(txt)
+    return last_update, lines, ann_display, ann_key
+
+def _parse_bs4(html: str):
+    soup = BeautifulSoup(html, "lxml")
+    last_update = parse_last_update(soup)
+    ann_display, ann_key = parse_announce_date(soup)
+    return last_update, extract_lines(soup), ann_display, ann_key
+
+def parse_page(html: str):
+    """
+    Returns: (last_update, sections, ann_display, ann_key). Tries the lxml
+    fast path and falls back to BeautifulSoup when the markup doesn't match.
+    """
+    parsed = None
+    try:
+        with metrics.PARSE_SECONDS.time(stage="lxml"):
+            parsed = _parse_lxml(html)
+    except Exception as e:
+        log.warning("lxml parse failed, falling back to bs4: %s", e)
+    if parsed is None:
+        log.debug("using bs4 parser")
+        with metrics.PARSE_SECONDS.time(stage="bs4"):
+            parsed = _parse_bs4(html)
+    last_update, lines, ann_display, ann_key = parsed
+    with metrics.PARSE_SECONDS.time(stage="split_sections"):
+        sections = split_sections(lines)
+    return last_update, sections, ann_display, ann_key
+
+class Section:
+    """
+    One outage section, with everything the per-chat hot loop needs
+    computed once per crawl and shared by every chat.
+    """
+    __slots__ = ("title", "body", "text_norm", "hash", "start_hour", "hour_range")
+
+    def __init__(self, title: str, body: List[str]):
+        self.title = title
+        self.body = body
+        raw = title + "\n" + "\n".join(body)
+        # normalized text for matching (emoji-free, lowercased)
+        self.text_norm = normalize_for_match(raw)
+        self.hash = hashlib.sha256(raw.encode("utf-8", "ignore")).hexdigest()[:24]
+        self.start_hour = parse_start_hour_from_title(title)
+        self.hour_range = extract_hour_range_display(title)  # e.g. '۹ تا ۱۱'
+
+    def __iter__(self):
+        # keeps `title, body = section` working
+        yield self.title
+        yield self.body
+
+    def __eq__(self, other):
+        if not isinstance(other, Section):
+            return NotImplemented
+        return self.title == other.title and self.body == other.body
+
+    def __repr__(self):
+        return f"Section({self.title!r}, {self.body!r})"
+
+def split_sections(lines: List[str]) -> List[Section]:
+    sections: List[Section] = []
     title: Optional[str] = None
     body: List[str] = []
     for ln in lines:
         if is_section_start(ln):
             if title is not None:
-                sections.append((title, body))
+                sections.append(Section(title, body))
                 body = []
             title = ln
         else:
             if title is not None:
                 body.append(ln)
     if title is not None:
-        sections.append((title, body))
+        sections.append(Section(title, body))
     return sections
 
-def page_signature(sections: List[Tuple[str, List[str]]]) -> str:
+def page_signature(sections: List[Section]) -> str:
     h = hashlib.sha256()
-    for title, body in sections:
-        h.update(title.encode("utf-8", "ignore"))
-        h.update("\n".join(body).encode("utf-8", "ignore"))
+    for sec in sections:
+        h.update(sec.title.encode("utf-8", "ignore"))
+        h.update("\n".join(sec.body).encode("utf-8", "ignore"))
     return "sig:" + h.hexdigest()[:16]
 
+# ---- streaming mode: parse while downloading, stop after the announcement ----
+def _has_classes(el, *names: str) -> bool:
+    classes = (el.get("class") or "").split()
+    return all(n in classes for n in names)
+
+class _StreamParser:
+    """
+    Incremental counterpart of `_parse_lxml`. Lines are slotted in p/li
+    start order (what bs4's select returns) and filled in when each element
+    closes. `feed` returns True once the AnnDescription container has closed
+    and the last-update control and a dated AnnTitle have been seen, so the
+    rest of the page never needs to be read.
+    """
+
+    def __init__(self, encoding: str):
+        self._parser = etree.HTMLPullParser(events=("start", "end"), encoding=encoding)
+        self._lines: List[Optional[str]] = []
+        self._slots: Dict[object, int] = {}
+        self._container = None
+        self.container_done = False
+        self._lu_el = None
+        self._lu_done = False
+        self.last_update: Optional[str] = None
+        self.ann_display: Optional[str] = None
+        self.ann_key: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> bool:
+        self._parser.feed(chunk)
+        return self._drain()
+
+    def close(self) -> bool:
+        self._parser.close()
+        return self._drain()
+
+    def _drain(self) -> bool:
+        for ev, el in self._parser.read_events():
+            tag = el.tag
+            if not isinstance(tag, str):
+                continue
+            if ev == "start":
+                if self._lu_el is None and el.get("id") == LAST_UPDATE_SELECTOR_ID:
+                    self._lu_el = el
+                if self._container is None:
+                    if tag == "div" and _has_classes(el, "AnnDescription"):
+                        self._container = el
+                elif not self.container_done and tag in ("p", "li"):
+                    self._slots[el] = len(self._lines)
+                    self._lines.append(None)
+                continue
+
+            if el is self._lu_el and not self._lu_done:
+                self.last_update = _last_update_from_text(_lx_text(el))
+                self._lu_done = True
+            elif self.ann_key is None and tag == "span" and _has_classes(el, "ItemTitle", "AnnTitle"):
+                self.ann_display, self.ann_key = extract_announce_date_key(clean_text(_lx_text(el)))
+            idx = self._slots.pop(el, None)
+            if idx is not None:
+                self._lines[idx] = _line_from_text(_lx_text(el))
+            elif el is self._container:
+                self.container_done = True
+        return self.container_done and self._lu_done and self.ann_key is not None
+
+    def result(self):
+        lines = [ln for ln in self._lines if ln]
+        return self.last_update, split_sections(lines), self.ann_display, self.ann_key
+
+# lxml parser objects must stay on one thread; all streaming feeds run here
+_stream_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream-parse")
+
+async def crawl_streaming(url: str = DEFAULT_URL, timeout=30, retries=3, backoff=2.0):
+    """
+    Like `crawl`, but feeds response chunks to an incremental parser and
+    stops downloading once the announcement block is complete. Falls back
+    to the regular full-page crawl when the page has no AnnDescription.
+    """
+    state = _pages.setdefault(url, _PageState())
+    headers = _conditional_headers(state)
+    loop = asyncio.get_running_loop()
+
+    last_err = None
+    for attempt in range(1, retries + 1):
+        try:
+            started = time.monotonic()
+            async with _get_client().stream("GET", url, headers=headers, timeout=timeout) as r:
+                if r.status_code == 304 and state.result is not None:
+                    log.debug("fetch not modified attempt=%s", attempt)
+                    metrics.FETCH_ATTEMPTS.inc(result="not_modified")
+                    return state.result
+                r.raise_for_status()
+                sp = _StreamParser(r.charset_encoding or "utf-8")
+                read = 0
+                done = False
+                async for chunk in r.aiter_bytes():
+                    read += len(chunk)
+                    if await loop.run_in_executor(_stream_executor, sp.feed, chunk):
+                        done = True
+                        break
+                if not done:
+                    await loop.run_in_executor(_stream_executor, sp.close)
+                etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+            metrics.FETCH_SECONDS.observe(time.monotonic() - started)
+            metrics.FETCH_ATTEMPTS.inc(result="ok")
+            break
+        except Exception as e:
+            metrics.FETCH_ATTEMPTS.inc(result="error")
+            last_err = e
+            log.warning("fetch failed attempt=%s err=%s", attempt, e)
+            await asyncio.sleep(backoff * attempt)
+    else:
+        raise RuntimeError(f"fetch failed after {retries} retries: {last_err}")
+
+    if not sp.container_done:
+        log.info("streaming: no AnnDescription container; falling back to full crawl")
+        return await crawl(url)
+
+    last_update, sections, ann_display, ann_key = sp.result()
+    took = time.monotonic() - started
+    log.info("crawl complete (streaming) | sections=%s lu=%s ann_key=%s bytes=%s early_stop=%s took=%.2fs",
+             len(sections), last_update, ann_key, read, done, took,
+             extra={"stage": "crawl_streaming", "update_key": ann_key or last_update,
+                    "duration_ms": round(took * 1000, 1)})
+    # a partial read can't be hashed against a full body (or archived); rely on validators only
+    state.etag, state.last_modified, state.body_hash = etag, last_modified, None
+    state.result = (last_update, sections, ann_display, ann_key)
+    return state.result
+
 async def crawl(url: str = DEFAULT_URL):
     """
     Returns: (last_update, sections, ann_display, ann_key)
     """
     html = await fetch_html(url)
-    soup = BeautifulSoup(html, "lxml")
-    last_update = parse_last_update(soup)
-    ann_display, ann_key = parse_announce_date(soup)
-    lines = extract_lines(soup)
-    sections = split_sections(lines)
-    log.info("crawl complete | sections=%s lu=%s ann_key=%s", len(sections), last_update, ann_key)
-    return last_update, sections, ann_display, ann_key
+    state = _pages[url]
+    if html is None:
+        log.debug("crawl unchanged; parse skipped | url=%s", url)
+        return state.result
+    try:
+        # parsing is CPU-bound; keep it off the event loop
+        loop = asyncio.get_running_loop()
+        last_update, sections, ann_display, ann_key = await loop.run_in_executor(None, parse_page, html)
+    except Exception:
+        # don't let validators of an unparsed body short-circuit the next fetch
+        state.etag = state.last_modified = state.body_hash = None
+        raise
+    log.info("crawl complete | sections=%s lu=%s ann_key=%s", len(sections), last_update, ann_key,
+             extra={"stage": "crawl", "update_key": ann_key or last_update})
+    archive.tag(url, state.body_hash, ann_key or last_update)
+    state.result = (last_update, sections, ann_display, ann_key)
+    return state.result
+
+
+# ---- single-flight snapshot cache shared by the crawler loop and commands ----
+_snapshots: Dict[str, Tuple[float, tuple]] = {}
+_inflight: Dict[str, "asyncio.Future"] = {}
+
+
+async def _refresh(url: str):
+    result = await (crawl_streaming(url) if CRAWL_STREAMING else crawl(url))
+    _snapshots[url] = (time.monotonic(), result)
+    return result
+
+
+async def crawl_cached(url: str = DEFAULT_URL, max_age: float = CRAWL_CACHE_TTL_SEC):
+    """
+    Same result as `crawl`, served from a snapshot no older than `max_age`
+    seconds. Concurrent callers share one in-flight crawl; `max_age=0`
+    forces a refresh (still coalesced with a crawl that is already running).
+    """
+    snap = _snapshots.get(url)
+    if snap is not None and time.monotonic() - snap[0] <= max_age:
+        return snap[1]
+    task = _inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_refresh(url))
+        _inflight[url] = task
+        task.add_done_callback(lambda _t: _inflight.pop(url, None))
+    # shield: a cancelled caller must not cancel the crawl others are awaiting
+    return await asyncio.shield(task)
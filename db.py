@@ -1,29 +1,192 @@
+import asyncio
 import sqlite3
 import time
-from contextlib import closing
-from typing import List, Optional, Tuple
-from config import DB_PATH
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+from config import DB_PATH, DB_COMMIT_INTERVAL_MS, DB_COMMIT_MAX_PENDING, DB_BUSY_TIMEOUT_SEC, SHARD_WORKERS
 import logging
+import metrics
+from textutils import normalize_for_match
 
 log = logging.getLogger("db")
 
-def init():
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("PRAGMA journal_mode=WAL;")
+T = TypeVar("T")
+# (index, count): only chats with chat_id % count == index (see shards.py)
+Shard = Optional[Tuple[int, int]]
+
+# One persistent connection, owned by a single executor thread. Every public
+# function is awaitable and runs its SQL on that thread, so the event loop
+# never blocks on SQLite. Writes are group-committed: they go into an open
+# transaction that is committed after DB_COMMIT_INTERVAL_MS or once
+# DB_COMMIT_MAX_PENDING writes have piled up, whichever comes first.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_con: Optional[sqlite3.Connection] = None
+_pending = 0
+_first_pending_at = 0.0
+_flush_handle: Optional[asyncio.TimerHandle] = None
+# With shard worker processes sharing the file, a transaction held open for
+# group commit would keep the write lock from every other process; each
+# write then commits on its own (WAL + synchronous=NORMAL: no fsync).
+_GROUP_COMMIT = SHARD_WORKERS == 0
+
+
+def _connect() -> sqlite3.Connection:
+    # with SHARD_WORKERS several processes write this file; a writer waits
+    # (up to the timeout) for another process's group commit to finish
+    con = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_SEC)
+    con.execute("PRAGMA journal_mode=WAL;")
+    # WAL + NORMAL: commits don't fsync, checkpoints do
+    con.execute("PRAGMA synchronous=NORMAL;")
+    return con
+
+
+def _commit_now():
+    global _pending
+    if _con is None or not _pending:
+        _pending = 0
+        return
+    n, _pending = _pending, 0
+    try:
+        _con.commit()
+    except sqlite3.Error:
+        # don't leave a half-open batch behind for the next commit to pick up
+        _con.rollback()
+        log.error("group commit failed; %s writes rolled back", n)
+        raise
+    log.debug("group commit | writes=%s", n)
+
+
+def _note_write():
+    global _pending, _first_pending_at
+    if not _pending:
+        _first_pending_at = time.monotonic()
+    _pending += 1
+    if (not _GROUP_COMMIT
+            or _pending >= DB_COMMIT_MAX_PENDING
+            or (time.monotonic() - _first_pending_at) * 1000 >= DB_COMMIT_INTERVAL_MS):
+        _commit_now()
+
+
+def _op_name(op) -> str:
+    # "get_setting.<locals>.op" -> "get_setting"
+    return op.__qualname__.split(".", 1)[0]
+
+
+async def _read(op: Callable[[sqlite3.Connection], T]) -> T:
+    loop = asyncio.get_running_loop()
+    with metrics.DB_SECONDS.time(op=_op_name(op)):
+        return await loop.run_in_executor(_executor, op, _con)
+
+
+async def _write(op: Callable[[sqlite3.Connection], T]) -> T:
+    def run(con):
+        # each op runs in a savepoint inside the open group-commit transaction:
+        # if it raises, its own statements are undone and nothing half-done
+        # gets committed along with the next batch
+        if not con.in_transaction:
+            # take the write lock up front: another process's writer then makes
+            # this wait in busy_timeout instead of failing a later lock upgrade
+            con.execute("BEGIN IMMEDIATE")
+        con.execute("SAVEPOINT op")
+        try:
+            res = op(con)
+        except BaseException:
+            con.execute("ROLLBACK TO op")
+            con.execute("RELEASE op")
+            raise
+        con.execute("RELEASE op")
+        _note_write()
+        return res
+
+    loop = asyncio.get_running_loop()
+    with metrics.DB_SECONDS.time(op=_op_name(op)):
+        res = await loop.run_in_executor(_executor, run, _con)
+    _schedule_flush(loop)
+    return res
+
+
+def _schedule_flush(loop: asyncio.AbstractEventLoop):
+    global _flush_handle
+    if _flush_handle is not None or not _pending:
+        return
+
+    def fire():
+        global _flush_handle
+        _flush_handle = None
+        loop.create_task(flush())
+
+    _flush_handle = loop.call_later(DB_COMMIT_INTERVAL_MS / 1000, fire)
+
+
+def _shard_sql(shard: Shard, column: str = "chat_id") -> Tuple[str, tuple]:
+    """SQL condition for `shard`; SQLite's % keeps the sign, so fold it like Python's."""
+    if shard is None:
+        return "1", ()
+    index, count = shard
+    return f"(({column} % ?) + ?) % ? = ?", (count, count, count, index)
+
+
+async def flush():
+    """Commit any pending writes now."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, _commit_now)
+
+
+async def close():
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+
+    def op():
+        global _con
+        _commit_now()
+        if _con is not None:
+            _con.close()
+            _con = None
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, op)
+
+
+async def init():
+    def op():
+        global _con
+        if _con is None:
+            _con = _connect()
+        con = _con
         con.execute("""
         CREATE TABLE IF NOT EXISTS chats(
             chat_id INTEGER PRIMARY KEY,
             url TEXT NOT NULL DEFAULT '',
-            created_at INTEGER NOT NULL
+            created_at INTEGER NOT NULL,
+            title TEXT,
+            title_at INTEGER
         );
         """)
+        # cached chat titles (see chattitles.py)
+        chat_cols = {r[1] for r in con.execute("PRAGMA table_info(chats)")}
+        if "title" not in chat_cols:
+            con.execute("ALTER TABLE chats ADD COLUMN title TEXT")
+        if "title_at" not in chat_cols:
+            con.execute("ALTER TABLE chats ADD COLUMN title_at INTEGER")
         con.execute("""
         CREATE TABLE IF NOT EXISTS keywords(
             chat_id INTEGER NOT NULL,
             keyword TEXT NOT NULL,
+            keyword_norm TEXT,
             UNIQUE(chat_id, keyword)
         );
         """)
+        # keyword_norm: normalize_for_match(keyword), so matching never re-normalizes keywords
+        if "keyword_norm" not in {r[1] for r in con.execute("PRAGMA table_info(keywords)")}:
+            con.execute("ALTER TABLE keywords ADD COLUMN keyword_norm TEXT")
+        rows = con.execute("SELECT rowid, keyword FROM keywords WHERE keyword_norm IS NULL").fetchall()
+        if rows:
+            con.executemany("UPDATE keywords SET keyword_norm=? WHERE rowid=?",
+                            [(normalize_for_match(kw), rowid) for rowid, kw in rows])
+            log.info("keyword_norm backfilled | rows=%s", len(rows))
+        con.execute("CREATE INDEX IF NOT EXISTS idx_keywords_norm ON keywords(chat_id, keyword_norm);")
         con.execute("""
         CREATE TABLE IF NOT EXISTS settings(
             key TEXT PRIMARY KEY,
@@ -40,83 +203,540 @@ def init():
             PRIMARY KEY(chat_id, last_update, section_hash)
         );
         """)
+        # (last_update, sent_at) lets expired_update_keys seek instead of scanning;
+        # it replaces the older last_update-only index
+        con.execute("CREATE INDEX IF NOT EXISTS idx_sent_last_update_at ON sent_sections(last_update, sent_at);")
+        con.execute("DROP INDEX IF EXISTS idx_sent_last_update;")
+        # lifetime send counters, maintained by mark_sent_many in the same transaction
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS sent_counters(
+            chat_id INTEGER PRIMARY KEY,
+            sent INTEGER NOT NULL DEFAULT 0
+        );
+        """)
+        if (con.execute("SELECT 1 FROM sent_counters LIMIT 1").fetchone() is None
+                and con.execute("SELECT 1 FROM sent_sections LIMIT 1").fetchone() is not None):
+            con.execute("""
+                INSERT INTO sent_counters(chat_id, sent)
+                SELECT chat_id, COUNT(*) FROM sent_sections GROUP BY chat_id
+            """)
+            log.info("sent_counters backfilled from sent_sections")
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS update_changes(
+            update_key TEXT NOT NULL,
+            seen_at INTEGER NOT NULL,
+            url TEXT NOT NULL DEFAULT ''
+        );
+        """)
+        # url: the source whose key changed ('' = DEFAULT_URL, as in chats.url)
+        if "url" not in {r[1] for r in con.execute("PRAGMA table_info(update_changes)")}:
+            con.execute("ALTER TABLE update_changes ADD COLUMN url TEXT NOT NULL DEFAULT ''")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_update_changes_seen ON update_changes(seen_at);")
+        # durable outbox: rendered messages waiting for delivery (see outbox.py)
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY,
+            idem_key TEXT NOT NULL UNIQUE,
+            chat_id INTEGER NOT NULL,
+            last_update TEXT NOT NULL,
+            parts TEXT NOT NULL,
+            sections TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            parts_sent INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'pending',
+            next_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_error TEXT
+        );
+        """)
+        con.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(state, next_at);")
+        # parsed pages published by the crawler for the shard workers (see shards.py)
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS published(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            update_key TEXT NOT NULL,
+            ann_display TEXT,
+            sections TEXT NOT NULL,
+            published_at INTEGER NOT NULL
+        );
+        """)
+        # admin broadcasts and their per-chat results (see broadcast.py)
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            admin_chat INTEGER NOT NULL,
+            progress_msg INTEGER,
+            state TEXT NOT NULL DEFAULT 'running',
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        );
+        """)
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_targets(
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            done_at INTEGER,
+            PRIMARY KEY(broadcast_id, chat_id)
+        );
+        """)
         con.commit()
+
+        # incremental vacuum needs auto_vacuum set once, then a full VACUUM to take effect
+        if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            log.info("enabling incremental auto_vacuum (one-time VACUUM)")
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            con.execute("VACUUM;")
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, op)
     log.info("DB initialized at %s", DB_PATH)
 
-def get_setting(key: str) -> Optional[str]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+async def get_setting(key: str) -> Optional[str]:
+    def op(con):
         row = con.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
         return row[0] if row else None
+    return await _read(op)
 
-def set_setting(key: str, value: str):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+async def set_setting(key: str, value: str):
+    def op(con):
         con.execute("""
             INSERT INTO settings(key,value) VALUES(?,?)
             ON CONFLICT(key) DO UPDATE SET value=excluded.value
         """, (key, value))
-        con.commit()
+    await _write(op)
 
-def upsert_chat(chat_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        now = int(time.time())
-        row = con.execute("SELECT chat_id FROM chats WHERE chat_id=?", (chat_id,)).fetchone()
-        if not row:
-            con.execute("INSERT INTO chats(chat_id,url,created_at) VALUES(?,?,?)",
-                        (chat_id, "", now))
-        con.commit()
+async def upsert_chat(chat_id: int):
+    def op(con):
+        con.execute("INSERT OR IGNORE INTO chats(chat_id,url,created_at) VALUES(?,?,?)",
+                    (chat_id, "", int(time.time())))
+    await _write(op)
     log.debug("chat upserted | chat=%s", chat_id)
 
-def add_keyword(chat_id: int, kw: str) -> bool:
+async def add_keyword(chat_id: int, kw: str) -> bool:
     kw = kw.strip()
-    if not kw:
+    kw_norm = normalize_for_match(kw)
+    if not kw_norm:
         return False
-    with closing(sqlite3.connect(DB_PATH)) as con:
+
+    def op(con):
+        # same keyword in another spelling (ي/ی, ZWNJ, digits...) counts as existing
+        if con.execute("SELECT 1 FROM keywords WHERE chat_id=? AND keyword_norm=?",
+                       (chat_id, kw_norm)).fetchone():
+            return False
         try:
-            con.execute("INSERT INTO keywords(chat_id, keyword) VALUES(?,?)", (chat_id, kw))
-            con.commit()
-            log.info("keyword added | chat=%s kw=%s", chat_id, kw)
+            con.execute("INSERT INTO keywords(chat_id, keyword, keyword_norm) VALUES(?,?,?)",
+                        (chat_id, kw, kw_norm))
             return True
         except sqlite3.IntegrityError:
             return False
 
-def del_keyword(chat_id: int, kw: str) -> bool:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        cur = con.execute("DELETE FROM keywords WHERE chat_id=? AND keyword=?", (chat_id, kw))
-        con.commit()
-        ok = cur.rowcount > 0
-        if ok:
-            log.info("keyword deleted | chat=%s kw=%s", chat_id, kw)
-        return ok
+    ok = await _write(op)
+    if ok:
+        log.info("keyword added | chat=%s kw=%s", chat_id, kw)
+    return ok
+
+async def del_keyword(chat_id: int, kw: str) -> bool:
+    def op(con):
+        cur = con.execute("DELETE FROM keywords WHERE chat_id=? AND (keyword=? OR keyword_norm=?)",
+                          (chat_id, kw, normalize_for_match(kw)))
+        return cur.rowcount > 0
 
-def list_keywords(chat_id: int) -> List[str]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    ok = await _write(op)
+    if ok:
+        log.info("keyword deleted | chat=%s kw=%s", chat_id, kw)
+    return ok
+
+async def list_keywords(chat_id: int) -> List[str]:
+    def op(con):
         rows = con.execute("SELECT keyword FROM keywords WHERE chat_id=? ORDER BY keyword", (chat_id,)).fetchall()
         return [r[0] for r in rows]
+    return await _read(op)
+
+async def list_subscriptions(shard: Shard = None) -> List[Tuple[int, str, str, str]]:
+    """Every (chat_id, keyword, keyword_norm, url) of registered chats (of one shard), in one query."""
+    cond, args = _shard_sql(shard, "k.chat_id")
 
-def list_chats() -> List[Tuple[int, str, int]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    def op(con):
+        return con.execute(f"""
+            SELECT k.chat_id, k.keyword, k.keyword_norm, c.url FROM keywords k
+            JOIN chats c ON c.chat_id = k.chat_id
+            WHERE {cond}
+            ORDER BY k.chat_id, k.keyword
+        """, args).fetchall()
+    return await _read(op)
+
+async def get_chat_url(chat_id: int) -> str:
+    def op(con):
+        row = con.execute("SELECT url FROM chats WHERE chat_id=?", (chat_id,)).fetchone()
+        return row[0] if row else ""
+    return await _read(op)
+
+async def set_chat_url(chat_id: int, url: str) -> bool:
+    def op(con):
+        cur = con.execute("UPDATE chats SET url=? WHERE chat_id=?", (url, chat_id))
+        return cur.rowcount > 0
+    return await _write(op)
+
+async def settings_with_prefix(prefix: str) -> List[Tuple[str, str]]:
+    def op(con):
+        return con.execute(
+            "SELECT key, value FROM settings WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff")
+        ).fetchall()
+    return await _read(op)
+
+async def list_chats() -> List[Tuple[int, str, int]]:
+    def op(con):
         return con.execute("SELECT chat_id, url, created_at FROM chats ORDER BY created_at DESC").fetchall()
+    return await _read(op)
 
-def has_sent(chat_id: int, last_update: str, section_hash: str) -> bool:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        row = con.execute("""
-            SELECT 1 FROM sent_sections WHERE chat_id=? AND last_update=? AND section_hash=?
-        """, (chat_id, last_update, section_hash)).fetchone()
-        return bool(row)
+async def list_chats_with_titles() -> List[Tuple[int, Optional[str], int]]:
+    """(chat_id, cached title or None, created_at), newest first."""
+    def op(con):
+        return con.execute("SELECT chat_id, title, created_at FROM chats ORDER BY created_at DESC").fetchall()
+    return await _read(op)
 
-def mark_sent(chat_id: int, last_update: str, section_hash: str, title: str):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("""
+async def set_chat_titles(rows: List[Tuple[int, str]]):
+    """Store (chat_id, title) pairs; unknown chats are ignored."""
+    if not rows:
+        return
+    now = int(time.time())
+    def op(con):
+        con.executemany("UPDATE chats SET title=?, title_at=? WHERE chat_id=?",
+                        [(t, now, c) for c, t in rows])
+    await _write(op)
+
+async def stale_title_chats(older_than: int, limit: int) -> List[int]:
+    """Chats with no title or one fetched before `older_than`, missing ones first."""
+    def op(con):
+        return [r[0] for r in con.execute("""
+            SELECT chat_id FROM chats WHERE title_at IS NULL OR title_at < ?
+            ORDER BY title_at IS NOT NULL, title_at LIMIT ?
+        """, (older_than, limit))]
+    return await _read(op)
+
+async def mark_sent(chat_id: int, last_update: str, section_hash: str, title: str):
+    await mark_sent_many([(chat_id, last_update, section_hash, title)])
+
+async def sent_hashes(chat_id: int, last_update: str) -> Set[str]:
+    """Hashes already sent to one chat for this update key (one PK-prefix query)."""
+    def op(con):
+        rows = con.execute(
+            "SELECT section_hash FROM sent_sections WHERE chat_id=? AND last_update=?",
+            (chat_id, last_update),
+        ).fetchall()
+        return {r[0] for r in rows}
+    return await _read(op)
+
+async def sent_hashes_by_chat(last_update: str, shard: Shard = None) -> Dict[int, Set[str]]:
+    """Hashes already sent for this update key, for every chat (of one shard) at once."""
+    cond, args = _shard_sql(shard)
+
+    def op(con):
+        out: Dict[int, Set[str]] = {}
+        for chat_id, sh in con.execute(
+            f"SELECT chat_id, section_hash FROM sent_sections WHERE last_update=? AND {cond}",
+            (last_update,) + args,
+        ):
+            out.setdefault(chat_id, set()).add(sh)
+        return out
+    return await _read(op)
+
+async def mark_sent_many(rows: List[Tuple[int, str, str, str]]):
+    """Record (chat_id, last_update, section_hash, title) rows in one executemany."""
+    if not rows:
+        return
+    now = int(time.time())
+
+    def op(con):
+        _insert_sent(con, rows, now)
+    await _write(op)
+    # tag the log line only with fields every row shares
+    extra = {}
+    if all(r[0] == rows[0][0] for r in rows):
+        extra["chat_id"] = rows[0][0]
+    if all(r[1] == rows[0][1] for r in rows):
+        extra["update_key"] = rows[0][1]
+    log.debug("marked sent | rows=%s", len(rows), extra=extra)
+
+def _insert_sent(con: sqlite3.Connection, rows: Iterable[Tuple[int, str, str, str]], now: int):
+    by_chat: Dict[int, List[Tuple[int, str, str, str, int]]] = {}
+    for c, lu, sh, t in rows:
+        by_chat.setdefault(c, []).append((c, lu, sh, t, now))
+    for chat_id, chat_rows in by_chat.items():
+        cur = con.executemany("""
             INSERT OR IGNORE INTO sent_sections(chat_id,last_update,section_hash,title,sent_at)
             VALUES(?,?,?,?,?)
-        """, (chat_id, last_update, section_hash, title, int(time.time())))
-        con.commit()
-    log.debug("marked sent | chat=%s lu=%s hash=%s", chat_id, last_update, section_hash)
+        """, chat_rows)
+        if cur.rowcount > 0:
+            con.execute("""
+                INSERT INTO sent_counters(chat_id, sent) VALUES(?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET sent = sent + excluded.sent
+            """, (chat_id, cur.rowcount))
 
-def stats():
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        total_sent = con.execute("SELECT COUNT(*) FROM sent_sections").fetchone()[0]
+async def stats():
+    """Lifetime sends, read from sent_counters (unaffected by retention pruning)."""
+    def op(con):
         per_chat = con.execute(
-            "SELECT chat_id, COUNT(*) FROM sent_sections GROUP BY chat_id ORDER BY COUNT(*) DESC"
+            "SELECT chat_id, sent FROM sent_counters WHERE sent > 0 ORDER BY sent DESC"
         ).fetchall()
-    return total_sent, per_chat
+        return sum(cnt for _cid, cnt in per_chat), per_chat
+    return await _read(op)
+
+async def record_update_change(update_key: str, seen_at: int, url: str = ""):
+    def op(con):
+        con.execute("INSERT INTO update_changes(update_key, seen_at, url) VALUES(?,?,?)",
+                    (update_key, seen_at, url))
+    await _write(op)
+
+async def list_update_changes(since: int) -> List[Tuple[str, int]]:
+    """(url, seen_at) of every source's key changes since `since`; url '' is DEFAULT_URL."""
+    def op(con):
+        return con.execute("SELECT url, seen_at FROM update_changes WHERE seen_at >= ?", (since,)).fetchall()
+    return await _read(op)
+
+# ---- outbox ----
+OutboxRow = Tuple[int, int, str, str, str, int, int, int]
+
+async def outbox_enqueue_many(rows: List[Tuple[str, int, str, str, str, int]]) -> int:
+    """
+    Queue (idem_key, chat_id, last_update, parts_json, sections_json, priority)
+    rows; a row whose idem_key is already queued is ignored. Committed before
+    returning. Returns rows added.
+    """
+    if not rows:
+        return 0
+    now = int(time.time())
+
+    def op(con):
+        before = con.total_changes
+        con.executemany("""
+            INSERT OR IGNORE INTO outbox(idem_key,chat_id,last_update,parts,sections,priority,next_at,created_at)
+            VALUES(?,?,?,?,?,?,?,?)
+        """, [r + (now, now) for r in rows])
+        return con.total_changes - before
+    n = await _write(op)
+    await flush()
+    return n
+
+async def outbox_due(now: int, limit: int, exclude: Iterable[int] = (), shard: Shard = None) -> List[OutboxRow]:
+    """Pending rows (of one shard) due by `now`, most urgent first:
+    (id, chat_id, last_update, parts, sections, priority, parts_sent, attempts)."""
+    exclude = set(exclude)
+    cond, args = _shard_sql(shard)
+
+    def op(con):
+        rows = con.execute(f"""
+            SELECT id, chat_id, last_update, parts, sections, priority, parts_sent, attempts
+            FROM outbox WHERE state='pending' AND next_at <= ? AND {cond}
+            ORDER BY priority, id LIMIT ?
+        """, (now,) + args + (limit + len(exclude),)).fetchall()
+        return [r for r in rows if r[0] not in exclude][:limit]
+    return await _read(op)
+
+async def outbox_next_at(shard: Shard = None) -> Optional[int]:
+    cond, args = _shard_sql(shard)
+
+    def op(con):
+        return con.execute(f"SELECT MIN(next_at) FROM outbox WHERE state='pending' AND {cond}",
+                           args).fetchone()[0]
+    return await _read(op)
+
+async def outbox_progress(row_id: int, parts_sent: int):
+    def op(con):
+        con.execute("UPDATE outbox SET parts_sent=? WHERE id=?", (parts_sent, row_id))
+    await _write(op)
+
+async def outbox_complete(row_id: int, sent_rows: List[Tuple[int, str, str, str]]):
+    """Drop a delivered row and record its sections as sent, in the same transaction."""
+    now = int(time.time())
+    def op(con):
+        con.execute("DELETE FROM outbox WHERE id=?", (row_id,))
+        _insert_sent(con, sent_rows, now)
+    await _write(op)
+
+async def outbox_retry(row_id: int, attempts: int, next_at: Optional[int], error: str):
+    """Reschedule a failed row at `next_at`, or mark it dead when `next_at` is None."""
+    def op(con):
+        con.execute("""
+            UPDATE outbox SET attempts=?, next_at=COALESCE(?, next_at), last_error=?,
+                state=CASE WHEN ? IS NULL THEN 'dead' ELSE state END
+            WHERE id=?
+        """, (attempts, next_at, error[:500], next_at, row_id))
+    await _write(op)
+
+async def outbox_stats(shard: Shard = None) -> Tuple[int, Optional[int], int]:
+    """(pending rows, created_at of the oldest pending row, dead rows), of one shard if given."""
+    cond, args = _shard_sql(shard)
+
+    def op(con):
+        pending, oldest = con.execute(
+            f"SELECT COUNT(*), MIN(created_at) FROM outbox WHERE state='pending' AND {cond}", args).fetchone()
+        dead = con.execute(f"SELECT COUNT(*) FROM outbox WHERE state='dead' AND {cond}", args).fetchone()[0]
+        return pending, oldest, dead
+    return await _read(op)
+
+async def prune_outbox_dead(older_than: int) -> int:
+    def op(con):
+        return con.execute("DELETE FROM outbox WHERE state='dead' AND created_at < ?",
+                           (older_than,)).rowcount
+    return await _write(op)
+
+# ---- published pages (sharded fan-out) ----
+PublishedRow = Tuple[int, str, str, Optional[str], str]
+
+async def publish(url: str, update_key: str, ann_display: Optional[str], sections_json: str) -> int:
+    """Store a parsed page for the shard workers; committed before returning. Returns its id."""
+    now = int(time.time())
+
+    def op(con):
+        return con.execute("""
+            INSERT INTO published(url, update_key, ann_display, sections, published_at) VALUES(?,?,?,?,?)
+        """, (url, update_key, ann_display, sections_json, now)).lastrowid
+    row_id = await _write(op)
+    await flush()
+    return row_id
+
+async def published_since(after_id: int) -> List[PublishedRow]:
+    """(id, url, update_key, ann_display, sections_json) published after `after_id`, oldest first."""
+    def op(con):
+        return con.execute("""
+            SELECT id, url, update_key, ann_display, sections FROM published WHERE id > ? ORDER BY id
+        """, (after_id,)).fetchall()
+    return await _read(op)
+
+async def published_latest() -> List[PublishedRow]:
+    """The newest published page of every source, oldest first."""
+    def op(con):
+        return con.execute("""
+            SELECT id, url, update_key, ann_display, sections FROM published
+            WHERE id IN (SELECT MAX(id) FROM published GROUP BY url) ORDER BY id
+        """).fetchall()
+    return await _read(op)
+
+async def prune_published(older_than: int) -> int:
+    """Drop published pages older than `older_than`, keeping the newest of every source."""
+    def op(con):
+        return con.execute("""
+            DELETE FROM published WHERE published_at < ?
+            AND id NOT IN (SELECT MAX(id) FROM published GROUP BY url)
+        """, (older_than,)).rowcount
+    return await _write(op)
+
+# ---- broadcasts ----
+async def broadcast_create(text: str, admin_chat: int, chat_ids: Iterable[int]) -> int:
+    """New running broadcast with every target pending; committed before returning."""
+    now = int(time.time())
+    def op(con):
+        cur = con.execute("INSERT INTO broadcasts(text, admin_chat, created_at) VALUES(?,?,?)",
+                          (text, admin_chat, now))
+        bid = cur.lastrowid
+        con.executemany("INSERT OR IGNORE INTO broadcast_targets(broadcast_id, chat_id) VALUES(?,?)",
+                        [(bid, c) for c in chat_ids])
+        return bid
+    bid = await _write(op)
+    await flush()
+    return bid
+
+async def broadcast_get(broadcast_id: int) -> Optional[Tuple[int, str, int, Optional[int], str]]:
+    """(id, text, admin_chat, progress_msg, state) or None."""
+    def op(con):
+        return con.execute("SELECT id, text, admin_chat, progress_msg, state FROM broadcasts WHERE id=?",
+                           (broadcast_id,)).fetchone()
+    return await _read(op)
+
+async def broadcast_ids(state: str) -> List[int]:
+    def op(con):
+        return [r[0] for r in con.execute("SELECT id FROM broadcasts WHERE state=? ORDER BY id", (state,))]
+    return await _read(op)
+
+async def broadcast_set_state(broadcast_id: int, state: str):
+    finished = int(time.time()) if state in ("done", "cancelled") else None
+    def op(con):
+        con.execute("UPDATE broadcasts SET state=?, finished_at=? WHERE id=?", (state, finished, broadcast_id))
+    await _write(op)
+    await flush()
+
+async def broadcast_set_progress_msg(broadcast_id: int, msg_id: int):
+    def op(con):
+        con.execute("UPDATE broadcasts SET progress_msg=? WHERE id=?", (msg_id, broadcast_id))
+    await _write(op)
+
+async def broadcast_pending(broadcast_id: int) -> List[int]:
+    def op(con):
+        return [r[0] for r in con.execute(
+            "SELECT chat_id FROM broadcast_targets WHERE broadcast_id=? AND status='pending'",
+            (broadcast_id,))]
+    return await _read(op)
+
+async def broadcast_result(broadcast_id: int, chat_id: int, status: str, error: Optional[str] = None):
+    def op(con):
+        con.execute("""
+            UPDATE broadcast_targets SET status=?, error=?, done_at=? WHERE broadcast_id=? AND chat_id=?
+        """, (status, error[:300] if error else None, int(time.time()), broadcast_id, chat_id))
+    await _write(op)
+
+async def broadcast_counts(broadcast_id: int) -> Dict[str, int]:
+    """Targets per status ('pending', 'ok', 'failed')."""
+    def op(con):
+        return dict(con.execute(
+            "SELECT status, COUNT(*) FROM broadcast_targets WHERE broadcast_id=? GROUP BY status",
+            (broadcast_id,)).fetchall())
+    return await _read(op)
+
+async def broadcast_failures(broadcast_id: int, limit: int = 20) -> List[Tuple[int, str]]:
+    def op(con):
+        return con.execute("""
+            SELECT chat_id, error FROM broadcast_targets
+            WHERE broadcast_id=? AND status='failed' ORDER BY done_at LIMIT ?
+        """, (broadcast_id, limit)).fetchall()
+    return await _read(op)
+
+# ---- retention / compaction ----
+async def expired_update_keys(older_than: int, keep: Iterable[str] = ()) -> List[str]:
+    """Update keys whose newest sent row is older than `older_than` (unix time), minus `keep`."""
+    keep = set(keep)
+
+    def op(con):
+        # walk the distinct keys with index seeks (a few per key) rather than
+        # grouping the whole table; there are only a handful of keys per day
+        out = []
+        key = con.execute("SELECT MIN(last_update) FROM sent_sections").fetchone()[0]
+        while key is not None:
+            newest = con.execute("SELECT MAX(sent_at) FROM sent_sections WHERE last_update=?",
+                                 (key,)).fetchone()[0]
+            if newest < older_than and key not in keep:
+                out.append(key)
+            key = con.execute("SELECT MIN(last_update) FROM sent_sections WHERE last_update > ?",
+                              (key,)).fetchone()[0]
+        return out
+    return await _read(op)
+
+async def prune_sent_batch(last_update: str, batch: int) -> int:
+    """Delete up to `batch` rows of one update key; returns rows deleted."""
+    def op(con):
+        cur = con.execute("""
+            DELETE FROM sent_sections WHERE rowid IN (
+                SELECT rowid FROM sent_sections WHERE last_update=? LIMIT ?
+            )
+        """, (last_update, batch))
+        return cur.rowcount
+    n = await _write(op)
+    # commit each batch on its own so a prune never holds the write lock for long
+    await flush()
+    return n
+
+async def compact(vacuum_pages: int):
+    """Give free pages back to the filesystem and fold the WAL into the main DB."""
+    def op():
+        _commit_now()
+        _con.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)});").fetchall()
+        return _con.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+
+    loop = asyncio.get_running_loop()
+    busy, wal_pages, checkpointed = await loop.run_in_executor(_executor, op)
+    log.debug("compact | wal_pages=%s checkpointed=%s busy=%s", wal_pages, checkpointed, busy)
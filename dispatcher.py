@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telethon.errors import FloodWaitError
+
+import metrics
+from config import (
+    DISPATCH_WORKERS,
+    DISPATCH_GLOBAL_RATE,
+    DISPATCH_GLOBAL_BURST,
+    DISPATCH_PER_CHAT_INTERVAL,
+    DISPATCH_MAX_RETRIES,
+)
+
+log = logging.getLogger("dispatcher")
+
+
+class RateLimiter:
+    """
+    Global token bucket (bot-wide messages/sec) plus a minimum spacing per
+    chat. `acquire(chat_id)` waits until both allow one more message.
+    """
+
+    def __init__(self, rate: float, burst: int, per_chat_interval: float):
+        self.rate = rate
+        self.burst = burst
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._chat_next: Dict[int, float] = {}
+
+    def split(self, n: int):
+        """Keep 1/n of the global budget, for one of n processes sending as the same bot."""
+        self.rate /= n
+        self.burst = max(1, self.burst // n)
+        self._tokens = min(self._tokens, float(self.burst))
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def acquire(self, chat_id: int):
+        # reserve this chat's next slot first so concurrent senders queue up behind it
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, chat_id: int, seconds: float):
+        """Telegram told us to back off this chat (FloodWait)."""
+        until = time.monotonic() + seconds
+        if self._chat_next.get(chat_id, 0.0) < until:
+            self._chat_next[chat_id] = until
+
+
+class _Job:
+    __slots__ = ("chat_id", "fn", "attempts", "future")
+
+    def __init__(self, chat_id: int, fn: Callable[[], Awaitable], future: asyncio.Future):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.attempts = 0
+        self.future = future
+
+
+class Dispatcher:
+    """
+    Bounded worker pool for per-chat deliveries. Jobs are taken lowest
+    priority number first; a FloodWait reschedules the job after the wait
+    instead of blocking a worker, so one throttled chat never stalls the rest.
+    """
+
+    def __init__(
+        self,
+        workers: int = DISPATCH_WORKERS,
+        rate: float = DISPATCH_GLOBAL_RATE,
+        burst: int = DISPATCH_GLOBAL_BURST,
+        per_chat_interval: float = DISPATCH_PER_CHAT_INTERVAL,
+        max_retries: int = DISPATCH_MAX_RETRIES,
+    ):
+        self.limiter = RateLimiter(rate, burst, per_chat_interval)
+        self.max_retries = max_retries
+        self._n_workers = workers
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._seq = itertools.count()
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(i)) for i in range(self._n_workers)
+            ]
+
+    def submit(self, chat_id: int, fn: Callable[[], Awaitable], priority: int = 0) -> asyncio.Future:
+        """Queue `fn()` for `chat_id`; the returned future resolves to its result."""
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        # failures are already logged by the worker; don't warn about unretrieved exceptions
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        job = _Job(chat_id, fn, fut)
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return fut
+
+    async def join(self):
+        """Wait until every submitted job (including rescheduled ones) is finished."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _requeue(self, priority: int, job: _Job, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            self._queue.put_nowait((priority, next(self._seq), job))
+        finally:
+            self._queue.task_done()
+
+    async def _worker(self, n: int):
+        while True:
+            priority, _seq, job = await self._queue.get()
+            requeued = False
+            try:
+                job.attempts += 1
+                result = await job.fn()
+                if not job.future.done():
+                    job.future.set_result(result)
+            except FloodWaitError as e:
+                metrics.FLOOD_WAITS.inc()
+                self.limiter.penalize(job.chat_id, e.seconds)
+                if job.attempts <= self.max_retries:
+                    log.warning("flood wait | chat=%s seconds=%s attempt=%s; rescheduled",
+                                job.chat_id, e.seconds, job.attempts)
+                    asyncio.create_task(self._requeue(priority, job, e.seconds))
+                    requeued = True
+                else:
+                    log.error("flood wait | chat=%s giving up after %s attempts", job.chat_id, job.attempts)
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            except Exception as e:
+                log.exception("job failed | chat=%s err=%s", job.chat_id, e)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                if not requeued:
+                    self._queue.task_done()
+
+
+dispatcher = Dispatcher()
@@ -0,0 +1,360 @@
+"""
+Offline load test of the whole bot: no Telegram, no qepd.co.ir.
+
+    python loadtest.py                                  # 2000 chats, 3 synthetic updates
+    python loadtest.py --chats 10000 --keywords 5 --updates 5 --flood-rate 0.01
+    python loadtest.py --replay archive.db              # recorded pages, in fetch order
+
+Pages are served by a local HTTP stand-in for the portal (ETag / 304
+aware). TelegramClient is replaced by SimClient, which adds lognormal
+latency, FloodWait errors and random failures. Chats subscribe through
+the real /start and /addkw handlers, then the real periodic_crawler and
+outbox deliver each published page. Reported per update: end-to-end
+delivery time (publish -> a chat's last message), throughput of the
+first 95% of messages, FloodWaits, dead letters and DB write
+amplification (SQLite row changes per message, and bytes the process
+wrote per payload byte).
+"""
+import argparse
+import asyncio
+import json
+import lzma
+import math
+import os
+import random
+import re
+import socket
+import sqlite3
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# everything below must see the stand-in URL and a throwaway DB
+_TMP = tempfile.mkdtemp(prefix="qom-load-")
+_PORT = _free_port()
+os.environ["DEFAULT_URL"] = f"http://127.0.0.1:{_PORT}/page"
+# never the real bot.db / archive, even if they are exported in the shell
+os.environ["DB_PATH"] = os.path.join(_TMP, "load.db")
+os.environ["ARCHIVE_PATH"] = ""
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("LOG_DIR", os.path.join(_TMP, "logs"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("CRAWL_STREAMING", "0")
+
+from telethon import errors  # noqa: E402
+
+import bench  # noqa: E402
+import db  # noqa: E402
+import metrics  # noqa: E402
+from commands import register as register_commands  # noqa: E402
+from crawler import close_http_client  # noqa: E402
+from logging_config import setup_logging, stop_logging  # noqa: E402
+from main import periodic_crawler  # noqa: E402
+from outbox import outbox  # noqa: E402
+from scheduler import scheduler  # noqa: E402
+
+
+class PortalStandIn:
+    """Serves pages[current] with an ETag per version; answers 304 when it matches."""
+
+    def __init__(self, pages: List[bytes]):
+        self.pages = pages
+        self.current = 0
+        self.requests = 0
+
+    def publish(self, version: int):
+        self.current = version
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readline()
+            inm = None
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "if-none-match":
+                    inm = value.strip()
+            self.requests += 1
+            etag = f'"v{self.current}"'
+            if inm == etag:
+                head, body = "HTTP/1.1 304 Not Modified\r\n", b""
+            else:
+                head, body = "HTTP/1.1 200 OK\r\n", self.pages[self.current]
+            writer.write(
+                f"{head}ETag: {etag}\r\nContent-Type: text/html; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+class SimClient:
+    """
+    Stands in for TelegramClient: handlers registered with `on()` can be
+    fed synthetic messages, sends sleep a lognormal latency and sometimes
+    raise FloodWaitError or a generic failure.
+    """
+
+    def __init__(self, latency: float, flood_rate: float, flood_seconds: int, fail_rate: float, seed: int = 0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.handlers = []
+        self.delivered: List[tuple] = []  # (monotonic ts, chat_id, bytes)
+        self.floods = 0
+        self.failures = 0
+        self.replies = 0
+
+    def on(self, event):
+        def deco(fn):
+            self.handlers.append((event, fn))
+            return fn
+        return deco
+
+    async def _rpc(self):
+        await asyncio.sleep(self.rng.lognormvariate(math.log(self.latency), 0.5) if self.latency else 0)
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await self._rpc()
+        r = self.rng.random()
+        if r < self.flood_rate:
+            self.floods += 1
+            raise errors.FloodWaitError(request=None, capture=self.rng.randint(1, self.flood_seconds))
+        if r < self.flood_rate + self.fail_rate:
+            self.failures += 1
+            raise RuntimeError("simulated send failure")
+        self.delivered.append((time.monotonic(), chat_id, len(text.encode("utf-8"))))
+        return SimpleNamespace(id=len(self.delivered))
+
+    async def edit_message(self, chat_id, msg_id, text):
+        await self._rpc()
+
+    async def send_file(self, chat_id, path, caption=None):
+        await self._rpc()
+
+    async def get_entity(self, chat_id):
+        await self._rpc()
+        return SimpleNamespace(title=f"group {chat_id}")
+
+    async def dispatch(self, chat_id: int, text: str, private: bool = False):
+        """Run every handler whose pattern (and func) accepts this message."""
+        for ev, fn in self.handlers:
+            m = ev.pattern(text) if ev.pattern else None
+            if ev.pattern and not m:
+                continue
+            event = SimEvent(self, chat_id, text, m, private)
+            if ev.func and not ev.func(event):
+                continue
+            await fn(event)
+
+
+class SimEvent:
+    def __init__(self, client: SimClient, chat_id: int, text: str, match, private: bool):
+        self.client = client
+        self.chat_id = chat_id
+        self.sender_id = chat_id
+        self.raw_text = text
+        self.pattern_match = match
+        self.is_private = private
+        self.is_group = not private
+        self.is_channel = False
+        self.is_reply = False
+
+    async def reply(self, text, **kwargs):
+        self.client.replies += 1
+
+    async def get_chat(self):
+        return SimpleNamespace(title=f"group {self.chat_id}")
+
+
+def recorded_pages(path: str) -> List[bytes]:
+    """Distinct archived bodies (see archive.py) in first-fetch order."""
+    con = sqlite3.connect(path)
+    rows = con.execute("""
+        SELECT b.data FROM blobs b JOIN (
+            SELECT hash, MIN(fetched_at) AS first FROM fetches GROUP BY hash
+        ) f ON f.hash = b.hash ORDER BY f.first
+    """).fetchall()
+    con.close()
+    return [lzma.decompress(r[0]) for r in rows]
+
+
+def _proc_wchar() -> Optional[int]:
+    try:
+        with open("/proc/self/io") as f:
+            return int(re.search(r"wchar:\s*(\d+)", f.read()).group(1))
+    except (OSError, AttributeError):
+        return None
+
+
+async def _total_changes() -> int:
+    def total_changes(con):
+        return con.total_changes
+    return await db._read(total_changes)
+
+
+def _cycles() -> float:
+    return sum(metrics.CYCLES._values.values())
+
+
+async def _wait_delivered(timeout: float):
+    """Until a whole crawler cycle ran after publishing, and the outbox is empty."""
+    deadline = time.monotonic() + timeout
+    # the cycle in progress at publish time may have fetched the old page
+    cycles = _cycles()
+    while _cycles() < cycles + 2 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    while time.monotonic() < deadline:
+        pending, _oldest, _dead = await db.outbox_stats()
+        if pending == 0 and not outbox._inflight:
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+def _pct(sorted_vals: List[float], q: float) -> float:
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+def _phase_report(client: SimClient, start_idx: int, t0: float, changes: int, wchar: Optional[int]):
+    sent = client.delivered[start_idx:]
+    out = {"messages": len(sent), "chats": len({c for _t, c, _b in sent})}
+    if sent:
+        last_by_chat: Dict[int, float] = {}
+        for ts, chat, _b in sent:
+            last_by_chat[chat] = ts
+        e2e = sorted(ts - t0 for ts in last_by_chat.values())
+        times = sorted(ts for ts, _c, _b in sent)
+        # rate while the bulk went out; a few backed-off retries would dominate the full span
+        bulk = times[: max(1, int(len(times) * 0.95))]
+        span = bulk[-1] - times[0]
+        payload = sum(b for _t, _c, b in sent)
+        out.update(
+            e2e_p50_s=round(_pct(e2e, 0.5), 3),
+            e2e_p95_s=round(_pct(e2e, 0.95), 3),
+            e2e_max_s=round(e2e[-1], 3),
+            # a rate needs at least two sends spread over time
+            throughput_msg_s=round(len(bulk) / span, 1) if len(bulk) >= 2 and span > 0 else None,
+            payload_bytes=payload,
+            db_row_changes=changes,
+            db_rows_per_message=round(changes / len(sent), 2),
+        )
+        if wchar is not None:
+            out["bytes_written"] = wchar
+            out["write_amplification"] = round(wchar / max(payload, 1), 2)
+    return out
+
+
+async def run(args) -> dict:
+    if args.replay:
+        pages = recorded_pages(args.replay)[: args.updates or None]
+    else:
+        pages = [bench.make_page(args.sections, seed=v, day=v + 1).encode("utf-8")
+                 for v in range(args.updates)]
+    if not pages:
+        raise SystemExit("no pages to serve")
+
+    setup_logging()
+    await db.init()
+    # poll the stand-in at a fixed pace
+    scheduler.base = scheduler.min_delay = scheduler.max_delay = args.poll
+    scheduler.jitter = 0
+
+    server = PortalStandIn(pages)
+    srv = await asyncio.start_server(server.handle, "127.0.0.1", _PORT)
+    client = SimClient(args.latency, args.flood_rate, args.flood_seconds, args.fail_rate, seed=args.seed)
+    register_commands(client)
+
+    report = {"chats": args.chats, "keywords_per_chat": args.keywords, "pages": len(pages), "phases": []}
+
+    # ---- subscribe every chat through the real /start and /addkw handlers ----
+    subs = bench.make_subscriptions(args.chats, args.keywords, seed=args.seed)
+    by_chat: Dict[int, List[str]] = {}
+    for chat_id, kw in subs:
+        by_chat.setdefault(chat_id, []).append(kw)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def subscribe(chat_id: int, kws: List[str]):
+        async with sem:
+            await client.dispatch(chat_id, "/start")
+            for kw in kws:
+                try:
+                    await client.dispatch(chat_id, f"/addkw {kw}")
+                except Exception:
+                    pass  # simulated failures of the immediate /addkw send
+
+    t0 = time.monotonic()
+    await asyncio.gather(*(subscribe(c, kws) for c, kws in by_chat.items()))
+    took = time.monotonic() - t0
+    report["setup"] = {"handler_calls": len(by_chat) + len(subs), "seconds": round(took, 2),
+                       "calls_per_s": round((len(by_chat) + len(subs)) / took, 1),
+                       "addkw_messages": len(client.delivered)}
+    print(f"setup: {report['setup']}")
+
+    # ---- publish each page and let periodic_crawler + outbox deliver it ----
+    tasks = [asyncio.create_task(outbox.run(client)), asyncio.create_task(periodic_crawler())]
+    for v in range(len(pages)):
+        start_idx, floods = len(client.delivered), client.floods
+        changes, wchar = await _total_changes(), _proc_wchar()
+        server.publish(v)
+        t0 = time.monotonic()
+        ok = await _wait_delivered(args.timeout)
+        await db.flush()
+        changes = await _total_changes() - changes
+        wchar = (_proc_wchar() - wchar) if wchar is not None else None
+        phase = _phase_report(client, start_idx, t0, changes, wchar)
+        phase.update(version=v, drained=ok, flood_waits=client.floods - floods)
+        phase["dead_letters"] = (await db.outbox_stats())[2]
+        report["phases"].append(phase)
+        print(f"update {v}: {phase}")
+
+    for t in tasks:
+        t.cancel()
+    srv.close()
+    report["portal_requests"] = server.requests
+    await close_http_client()
+    await db.close()
+    stop_logging()
+    return report
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--chats", type=int, default=2000)
+    ap.add_argument("--keywords", type=int, default=3, help="keywords per chat")
+    ap.add_argument("--sections", type=int, default=200, help="sections per synthetic page")
+    ap.add_argument("--updates", type=int, default=3, help="pages to publish (with --replay: max pages)")
+    ap.add_argument("--replay", help="archive DB (ARCHIVE_PATH) to replay instead of synthetic pages")
+    ap.add_argument("--latency", type=float, default=0.05, help="median Telegram RPC latency, seconds")
+    ap.add_argument("--flood-rate", type=float, default=0.002, help="probability a send gets FloodWait")
+    ap.add_argument("--flood-seconds", type=int, default=3, help="max FloodWait seconds")
+    ap.add_argument("--fail-rate", type=float, default=0.001, help="probability a send fails outright")
+    ap.add_argument("--concurrency", type=int, default=100, help="concurrent command handlers during setup")
+    ap.add_argument("--poll", type=float, default=1.0, help="crawler interval, seconds")
+    ap.add_argument("--timeout", type=float, default=600, help="max seconds to drain one update")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="write the report as JSON here")
+    args = ap.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"saved -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,145 @@
+import copy
+import json
 import logging
 import logging.handlers
 import os
-from config import LOG_DIR, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from config import (
+    LOG_DIR, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT,
+    LOG_FORMAT, LOG_DEBUG_BURST, LOG_DEBUG_WINDOW_SEC,
+)
 
-def setup_logging():
+# LogRecord attributes that are not user fields (anything else came in via extra=)
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_EXC_FORMATTER = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with extra= (chat_id, update_key, duration_ms...) are kept."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + ".%03d" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for k, v in vars(record).items():
+            if k not in _RESERVED:
+                out[k] = v
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        if record.stack_info:
+            out["stack"] = record.stack_info
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    The stock prepare() formats the whole record (traceback included) into
+    msg before queueing, which would put the traceback inside JSON's "msg".
+    Here only the message is rendered; the traceback is kept as exc_text for
+    the listener's formatter (text appends it, JSON puts it in "exc").
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.message = record.msg
+        if record.exc_info:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DebugSampler(logging.Filter):
+    """
+    Lets through at most `burst` DEBUG records per message template in each
+    `window` seconds, so per-chat lines don't flood the log during a large
+    fan-out. The first record of the next window reports how many were dropped.
+    """
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._lock = threading.Lock()
+        # (logger, template) -> [window start, passed, dropped]
+        self._seen: Dict[Tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.DEBUG or self.burst <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = record.created
+        with self._lock:
+            st = self._seen.get(key)
+            if st is None or now - st[0] >= self.window:
+                dropped = st[2] if st else 0
+                self._seen[key] = [now, 1, 0]
+                if dropped:
+                    record.msg = f"{record.msg} (+{dropped} similar suppressed)"
+                return True
+            if st[1] < self.burst:
+                st[1] += 1
+                return True
+            st[2] += 1
+            return False
+
+
+def setup_logging(filename: str = "bot.log"):
+    """
+    Records are put on a queue by a QueueHandler (cheap, no I/O) and written
+    to the console and the rotating file by a QueueListener thread, so the
+    asyncio loop never blocks on log I/O or rotation. Each process needs its
+    own `filename`; rotation is not safe across processes.
+    """
+    global _listener
     os.makedirs(LOG_DIR, exist_ok=True)
-    log_path = os.path.join(LOG_DIR, "bot.log")
+    log_path = os.path.join(LOG_DIR, filename)
 
-    fmt = logging.Formatter("%(asctime)s | %(levelname)-8s | %(name)s | %(message)s")
+    if LOG_FORMAT.lower() == "json":
+        fmt: logging.Formatter = JsonFormatter()
+    else:
+        fmt = logging.Formatter("%(asctime)s | %(levelname)-8s | %(name)s | %(message)s")
 
+    level = LOG_LEVEL.upper()
     root = logging.getLogger()
-    root.setLevel(LOG_LEVEL.upper())
+    root.setLevel(level)
 
     ch = logging.StreamHandler()
-    ch.setLevel(LOG_LEVEL.upper())
+    ch.setLevel(level)
     ch.setFormatter(fmt)
-    root.addHandler(ch)
 
     fh = logging.handlers.RotatingFileHandler(
         log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
     )
-    fh.setLevel(LOG_LEVEL.upper())
+    fh.setLevel(level)
     fh.setFormatter(fmt)
-    root.addHandler(fh)
 
-    logging.getLogger(__name__).info("Logging initialized -> %s", log_path)
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    qh = _QueueHandler(q)
+    qh.addFilter(DebugSampler(LOG_DEBUG_BURST, LOG_DEBUG_WINDOW_SEC))
+    root.addHandler(qh)
+
+    _listener = logging.handlers.QueueListener(q, ch, fh, respect_handler_level=True)
+    _listener.start()
+
+    logging.getLogger(__name__).info("Logging initialized -> %s (format=%s)", log_path, LOG_FORMAT)
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,68 +1,177 @@
 import asyncio
 import logging
+import time
+from typing import Dict
 from telethon import TelegramClient
-from config import API_ID, API_HASH, BOT_TOKEN, PROXY, CRAWL_INTERVAL_MIN, DEFAULT_URL
-from logging_config import setup_logging
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, PROXY, DEFAULT_URL, METRICS_HOST, METRICS_PORT,
+    CRAWL_SOURCE_CONCURRENCY, SENT_RETENTION_DAYS, DB_PRUNE_BATCH, DB_MAINTENANCE_INTERVAL_MIN, DB_VACUUM_PAGES,
+    SHARD_WORKERS,
+)
+from logging_config import setup_logging, stop_logging
 import db
-from crawler import crawl, page_signature
-from notifier import send_matching_sections
+import metrics
+from crawler import crawl_cached, page_signature, close_http_client
+from notifier import RenderCache
+from matcher import registry
+from outbox import outbox
+from dispatcher import dispatcher
+from broadcast import engine as broadcasts
+import chattitles
+from scheduler import scheduler
+import profiling
+import archive
+import shards
 from commands import register as register_commands
 
 log = logging.getLogger("main")
 
-async def periodic_crawler(client: TelegramClient):
+# how soon a newly used source gets its own crawl loop
+_SOURCES_POLL_SEC = 5
+
+def _seen_setting(url: str) -> str:
+    # the default source keeps its historical settings key
+    return "last_update_seen" if url == DEFAULT_URL else f"last_update_seen:{url}"
+
+async def _process_source(url: str) -> str:
+    """Crawl one source and enqueue rendered messages for its chats (or publish
+    the page to the shard workers). Returns the outcome."""
+    try:
+        last_update, sections, ann_display, ann_key = await crawl_cached(url, max_age=0)
+    except Exception as e:
+        log.exception("fetch failed | url=%s: %s", url, e)
+        return "fetch_error"
+
+    if not sections:
+        log.warning("no sections parsed | url=%s; will retry later.", url)
+        return "empty"
+
+    # Prefer date key; fallback to last_update; then content signature
+    base_key = ann_key or last_update or page_signature(sections)
+
+    setting = _seen_setting(url)
+    prev = await db.get_setting(setting)
+    if prev == base_key:
+        log.debug("No change in update key (%s) | url=%s", base_key, url)
+        return "unchanged"
+
+    log.info("New update key: %s (prev: %s) | url=%s", base_key, prev, url)
+
+    if SHARD_WORKERS:
+        await shards.publish(url, base_key, sections, ann_display)
+    else:
+        # one cache per crawl: its fragments are shared by this page's chats only
+        await shards.fan_out(registry, url, base_key, sections, ann_display, outbox, RenderCache())
+
+    # the key is stored only once its messages (or the page) are durably queued;
+    # a crash in between re-enqueues the same messages, which the outbox ignores
+    await db.set_setting(setting, base_key)
+    if prev:  # skip first run and /forcecrawl resets
+        await scheduler.record_change(url, base_key)
+    return "ok"
+
+async def _crawl_source_loop(url: str, sem: asyncio.Semaphore):
+    """Crawl one source on its own schedule until no chat uses it any more.
+    A slow or failing source only delays itself."""
+    sched = scheduler.source(url)
+
+    async def crawl() -> str:
+        async with sem:
+            return await _process_source(url)
+
+    while url in registry.sources():
+        started = time.perf_counter()
+        try:
+            # /profile_cycle next or /memtop next
+            req = profiling.take_request()
+            outcome = await (req.run(crawl) if req is not None else crawl())
+            if outcome == "fetch_error":
+                sched.record_failure()
+            elif outcome in ("ok", "unchanged"):
+                sched.record_success()
+        except Exception as e:
+            log.exception("crawler loop error | url=%s: %s", url, e)
+            outcome = "error"
+        took = time.perf_counter() - started
+        metrics.CYCLE_SECONDS.observe(took)
+        metrics.CYCLES.inc(result=outcome)
+        log.info("cycle done | url=%s outcome=%s took=%.2fs", url, outcome, took,
+                 extra={"stage": "cycle", "duration_ms": round(took * 1000, 1)})
+
+        await asyncio.sleep(sched.next_delay())
+    log.info("source no longer used, crawl loop stopped | url=%s", url)
+
+async def periodic_crawler():
+    """One crawl loop per source; sources added with /setsource get theirs within _SOURCES_POLL_SEC."""
     print("[crawler] started")
+    sem = asyncio.Semaphore(CRAWL_SOURCE_CONCURRENCY)
+    loops: Dict[str, asyncio.Task] = {}
+    while True:
+        for url in registry.sources():
+            task = loops.get(url)
+            if task is None or task.done():
+                loops[url] = asyncio.create_task(_crawl_source_loop(url, sem))
+        await asyncio.sleep(_SOURCES_POLL_SEC)
+
+async def periodic_maintenance():
+    """Prune old dedup rows in small batches, then incremental VACUUM + WAL checkpoint."""
     while True:
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL_MIN * 60)
         try:
-            try:
-                last_update, sections, ann_display, ann_key = await crawl(DEFAULT_URL)
-            except Exception as e:
-                log.exception("fetch main URL failed: %s", e)
-                last_update, sections, ann_display, ann_key = None, [], None, None
-
-            if not sections:
-                log.warning("no sections parsed; will retry later.")
-            else:
-                # Prefer date key; fallback to last_update; then content signature
-                base_key = ann_key or last_update or page_signature(sections)
-                last_display = last_update if last_update else "نامشخص (شناسه محتوا)"
-
-                prev = db.get_setting("last_update_seen")
-                if prev != base_key:
-                    db.set_setting("last_update_seen", base_key)
-                    log.info("New update key: %s (prev: %s)", base_key, prev)
-
-                    chats = db.list_chats()
-                    for chat_id, _url, _created in chats:
-                        try:
-                            kws = db.list_keywords(chat_id)
-                            if not kws:
-                                continue
-                            sent = await send_matching_sections(client, chat_id, base_key, last_display,
-                                                                sections, kws, ann_display=ann_display)
-                            if sent:
-                                log.info("chat %s: sent %s sections.", chat_id, sent)
-                        except Exception as e:
-                            log.exception("chat %s: processing error: %s", chat_id, e)
-                else:
-                    log.debug("No change in update key (%s).", base_key)
+            cutoff = int(time.time()) - SENT_RETENTION_DAYS * 86400
+            current = [v for _k, v in await db.settings_with_prefix("last_update_seen") if v]
+            removed = 0
+            for key in await db.expired_update_keys(cutoff, keep=current):
+                while True:
+                    n = await db.prune_sent_batch(key, DB_PRUNE_BATCH)
+                    removed += n
+                    if n < DB_PRUNE_BATCH:
+                        break
+                    await asyncio.sleep(0)  # let other writers in between batches
+            if removed:
+                log.info("retention: pruned %s sent_sections rows", removed)
+            dead = await db.prune_outbox_dead(cutoff)
+            if dead:
+                log.info("retention: pruned %s dead outbox rows", dead)
+            await db.prune_published(cutoff)
+            await db.compact(DB_VACUUM_PAGES)
         except Exception as e:
-            log.exception("crawler loop error: %s", e)
-
-        await asyncio.sleep(CRAWL_INTERVAL_MIN * 60)
+            log.exception("maintenance error: %s", e)
 
 async def main():
     setup_logging()
-    db.init()
+    await db.init()
+    await registry.load()
+    await scheduler.load()
 
     client = TelegramClient("qepd_bot", API_ID, API_HASH, proxy=PROXY)
     await client.start(bot_token=BOT_TOKEN)
 
     register_commands(client)
+    await metrics.start_server(METRICS_HOST, METRICS_PORT)
 
-    asyncio.create_task(periodic_crawler(client))
+    workers = shards.Workers(SHARD_WORKERS)
+    if SHARD_WORKERS:
+        # the workers own delivery; this process crawls, publishes and answers commands,
+        # sending at its 1/(N+1) share of the bot-wide rate
+        dispatcher.limiter.split(SHARD_WORKERS + 1)
+        workers.start()
+        asyncio.create_task(workers.supervise())
+    else:
+        asyncio.create_task(outbox.run(client))
+    await broadcasts.resume_interrupted(client)
+    asyncio.create_task(chattitles.periodic_refresh(client))
+    asyncio.create_task(periodic_crawler())
+    asyncio.create_task(periodic_maintenance())
     log.info("Bot is up. Press Ctrl+C to stop.")
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        workers.stop()
+        await close_http_client()
+        await db.close()
+        archive.close()
+        stop_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,236 @@
+import logging
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import db
+from config import DEFAULT_URL
+from crawler import Section, source_url
+from textutils import normalize_for_match
+
+log = logging.getLogger("matcher")
+
+
+class AhoCorasick:
+    """
+    Multi-pattern substring matcher. Built once from every distinct keyword;
+    `find` walks the text a single time and returns the indices of all
+    patterns that occur in it.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+
+        for pid, pat in enumerate(patterns):
+            if not pat:
+                continue
+            node = 0
+            for ch in pat:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = nxt
+            self._out[node] = self._out[node] + (pid,)
+
+        # BFS to fill failure links; merge outputs along the failure chain
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                if self._out[self._fail[nxt]]:
+                    self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> Set[int]:
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Set[int] = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+class SubscriptionRegistry:
+    """
+    In-memory view of the (chat, keyword) subscriptions of one source,
+    kept in sync by add/remove. The automaton is rebuilt lazily, and only
+    when the set of distinct patterns actually changed.
+    """
+
+    def __init__(self):
+        self._by_chat: Dict[int, Dict[str, str]] = {}  # chat -> {keyword: pattern}
+        self._by_pattern: Dict[str, Set[Tuple[int, str]]] = {}
+        self._automaton: Optional[AhoCorasick] = None
+        self._pattern_ids: Dict[str, int] = {}
+        self._pattern_subs: List[List[Tuple[int, str]]] = []
+
+    def _add(self, chat_id: int, kw: str, pat: str) -> bool:
+        if not pat:
+            return False
+        kws = self._by_chat.setdefault(chat_id, {})
+        if kw in kws:
+            return False
+        kws[kw] = pat
+        subs = self._by_pattern.get(pat)
+        if subs is None:
+            self._by_pattern[pat] = subs = set()
+            self._automaton = None
+        subs.add((chat_id, kw))
+        if self._automaton is not None:
+            self._pattern_subs[self._pattern_ids[pat]] = sorted(subs)
+        return True
+
+    def add(self, chat_id: int, kw: str, pat: Optional[str] = None):
+        kw = kw.strip()
+        self._add(chat_id, kw, normalize_for_match(kw) if pat is None else pat)
+
+    def _remove(self, chat_id: int, kw: str, pat: str):
+        kws = self._by_chat[chat_id]
+        del kws[kw]
+        if not kws:
+            del self._by_chat[chat_id]
+        subs = self._by_pattern.get(pat)
+        if subs is None:
+            return
+        subs.discard((chat_id, kw))
+        if not subs:
+            del self._by_pattern[pat]
+            self._automaton = None
+        elif self._automaton is not None:
+            self._pattern_subs[self._pattern_ids[pat]] = sorted(subs)
+
+    def remove(self, chat_id: int, kw: str):
+        """Drop `kw` and any of the chat's keywords with the same normalized form."""
+        pat = normalize_for_match(kw)
+        for k, p in list(self._by_chat.get(chat_id, {}).items()):
+            if k == kw or p == pat:
+                self._remove(chat_id, k, p)
+
+    def items(self, chat_id: int) -> List[Tuple[str, str]]:
+        """(keyword, normalized pattern) pairs of one chat."""
+        return list(self._by_chat.get(chat_id, {}).items())
+
+    def keywords(self, chat_id: int) -> List[str]:
+        return list(self._by_chat.get(chat_id, ()))
+
+    def chats(self) -> Iterable[int]:
+        return self._by_chat.keys()
+
+    def _ensure_automaton(self) -> AhoCorasick:
+        if self._automaton is None:
+            patterns = list(self._by_pattern)
+            self._automaton = AhoCorasick(patterns)
+            self._pattern_ids = {p: i for i, p in enumerate(patterns)}
+            self._pattern_subs = [sorted(self._by_pattern[p]) for p in patterns]
+            log.debug("automaton rebuilt | patterns=%s", len(patterns))
+        return self._automaton
+
+    def match_sections(
+        self, sections: List[Section]
+    ) -> Dict[int, List[Tuple[int, List[str]]]]:
+        """
+        One automaton pass per section. Returns
+        {chat_id: [(section_index, matched_keywords), ...]} in section order.
+        """
+        ac = self._ensure_automaton()
+        hits: Dict[int, List[Tuple[int, List[str]]]] = {}
+        if not ac.patterns:
+            return hits
+        for idx, sec in enumerate(sections):
+            found = ac.find(sec.text_norm)
+            if not found:
+                continue
+            per_chat: Dict[int, List[str]] = {}
+            for pid in found:
+                for chat_id, kw in self._pattern_subs[pid]:
+                    per_chat.setdefault(chat_id, []).append(kw)
+            for chat_id, kws in per_chat.items():
+                hits.setdefault(chat_id, []).append((idx, kws))
+        return hits
+
+
+class SourceRegistry:
+    """
+    One SubscriptionRegistry per source URL (chats.url, '' = DEFAULT_URL),
+    loaded with one query. Each chat is only ever matched against the
+    sections of its own source.
+    """
+
+    def __init__(self):
+        self._by_source: Dict[str, SubscriptionRegistry] = {}
+        self._source_of: Dict[int, str] = {}
+
+    async def load(self, shard: db.Shard = None):
+        """Load every subscription, or only those of one shard (see shards.py)."""
+        rows = await db.list_subscriptions(shard)
+        self._by_source.clear()
+        self._source_of.clear()
+        for chat_id, kw, kw_norm, url in rows:
+            url = source_url(url)
+            self._source_of[chat_id] = url
+            # keywords are stored normalized; never re-normalized here
+            self._reg(url)._add(chat_id, kw, kw_norm)
+        log.info("subscriptions loaded | sources=%s chats=%s", len(self._by_source), len(self._source_of))
+
+    def _reg(self, url: str) -> SubscriptionRegistry:
+        reg = self._by_source.get(url)
+        if reg is None:
+            reg = self._by_source[url] = SubscriptionRegistry()
+        return reg
+
+    def add(self, chat_id: int, kw: str, url: Optional[str] = None):
+        url = source_url(url) if url is not None else self._source_of.get(chat_id, DEFAULT_URL)
+        if self._source_of.get(chat_id, url) != url:
+            self.set_source(chat_id, url)
+        self._source_of[chat_id] = url
+        self._reg(url).add(chat_id, kw)
+
+    def remove(self, chat_id: int, kw: str):
+        url = self._source_of.get(chat_id)
+        if url is None:
+            return
+        reg = self._reg(url)
+        reg.remove(chat_id, kw)
+        if not reg.keywords(chat_id):
+            del self._source_of[chat_id]
+
+    def set_source(self, chat_id: int, url: Optional[str]):
+        """Move a chat's keywords to another source."""
+        url = source_url(url)
+        old = self._source_of.get(chat_id)
+        if old is None or old == url:
+            return
+        for kw, pat in self._reg(old).items(chat_id):
+            self._reg(old)._remove(chat_id, kw, pat)
+            self._reg(url)._add(chat_id, kw, pat)
+        self._source_of[chat_id] = url
+
+    def keywords(self, chat_id: int) -> List[str]:
+        url = self._source_of.get(chat_id)
+        return self._reg(url).keywords(chat_id) if url else []
+
+    def sources(self) -> List[str]:
+        """DEFAULT_URL first, then every other source that has subscribers."""
+        others = [u for u, reg in self._by_source.items() if u != DEFAULT_URL and reg.chats()]
+        return [DEFAULT_URL] + sorted(others)
+
+    def match_sections(self, url: str, sections: List[Section]) -> Dict[int, List[Tuple[int, List[str]]]]:
+        return self._reg(url).match_sections(sections)
+
+
+registry = SourceRegistry()
@@ -0,0 +1,174 @@
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("metrics")
+
+# Recording is a dict lookup plus a bisect; all formatting happens on scrape.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_registry: List["_Metric"] = []
+
+
+def _fmt_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_num(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = super().render()
+        for key, v in sorted(self._values.items()):
+            out.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_num(v)}")
+        return out
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [counts per bucket (+Inf last)], sum
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self) -> List[str]:
+        out = super().render()
+        for key, (counts, total) in sorted(self._series.items()):
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                labels = _fmt_labels(self.labelnames, key, 'le="%s"' % le)
+                out.append(f"{self.name}_bucket{labels} {acc}")
+            acc += counts[-1]
+            labels = _fmt_labels(self.labelnames, key, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{labels} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_num(total[0])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {acc}")
+        return out
+
+
+def render() -> str:
+    lines: List[str] = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---- the bot's metrics ----
+FETCH_ATTEMPTS = Counter("qom_fetch_attempts_total", "fetch_html attempts by outcome", ["result"])
+FETCH_SECONDS = Histogram("qom_fetch_seconds", "Duration of one fetch_html attempt")
+PARSE_SECONDS = Histogram("qom_parse_seconds", "Page parse time by stage", ["stage"])
+DB_SECONDS = Histogram("qom_db_seconds", "Time spent in db.* calls (including executor queueing)", ["op"],
+                       buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+MATCH_SECONDS = Histogram("qom_match_seconds", "Keyword matching time per cycle")
+SEND_SECONDS = Histogram("qom_send_seconds", "Telegram send_message latency")
+SENDS = Counter("qom_sends_total", "Telegram send_message calls by outcome", ["result"])
+RENDER_CACHE = Counter("qom_render_cache_total", "Render cache lookups by kind and result", ["kind", "result"])
+FLOOD_WAITS = Counter("qom_flood_waits_total", "FloodWait errors received")
+CYCLE_SECONDS = Histogram("qom_cycle_seconds", "Crawl cycle duration (crawl + match + enqueue)")
+CYCLES = Counter("qom_cycles_total", "Crawl cycles by outcome", ["result"])
+OUTBOX_ENQUEUED = Counter("qom_outbox_enqueued_total", "Messages added to the outbox")
+OUTBOX_DELIVERIES = Counter("qom_outbox_deliveries_total", "Outbox delivery attempts by outcome", ["result"])
+OUTBOX_DEPTH = Gauge("qom_outbox_depth", "Messages pending in the outbox")
+OUTBOX_OLDEST_AGE = Gauge("qom_outbox_oldest_age_seconds", "Age of the oldest pending outbox message")
+OUTBOX_DEAD = Gauge("qom_outbox_dead", "Outbox messages given up on")
+SHARD_FANOUT_SKIPPED = Counter("qom_shard_fanout_skipped_total", "Published pages a shard gave up fanning out")
+
+
+# ---- scrape endpoint ----
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else "/"
+        if path.split("?")[0] in ("/metrics", "/"):
+            body = render().encode("utf-8")
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except Exception as e:
+        log.debug("metrics request failed: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    """Serve Prometheus text format on http://host:port/metrics (port 0 disables)."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle, host, port)
+    log.info("metrics endpoint on http://%s:%s/metrics", host, port)
+    return server
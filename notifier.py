@@ -1,15 +1,15 @@
 import html
-import hashlib
 import logging
 import re
-from typing import List, Tuple, Optional
+import time
+from functools import lru_cache
+from typing import Dict, Hashable, List, Optional, Set, Tuple
 from telethon import TelegramClient
-from db import has_sent, mark_sent
-from textutils import (
-    parse_start_hour_from_title,
-    normalize_for_match,
-    strip_decor_prefix,
-)
+import db
+import metrics
+from config import RENDER_CACHE_MAX_ENTRIES
+from crawler import Section
+from textutils import normalize_for_match, strip_decor_prefix
 
 log = logging.getLogger("notifier")
 
@@ -18,13 +18,31 @@ def _html_escape(s: str) -> str:
     return html.escape(s, quote=False)
 
 
+@lru_cache(maxsize=1024)
+def _highlighter(kws: Tuple[str, ...]) -> Optional["re.Pattern[str]"]:
+    """
+    One compiled alternation per distinct keyword set (LRU-cached).
+    Longest keywords first so the longest wins at each position.
+    """
+    if not kws:
+        return None
+    return re.compile("|".join(re.escape(k) for k in sorted(kws, key=len, reverse=True)))
+
+
 def _highlight_keywords_html(text: str, kws: List[str]) -> str:
-    safe = _html_escape(text)
-    # longest-first to avoid nested replacements
-    for kw in sorted(set([k for k in kws if k.strip()]), key=len, reverse=True):
-        kw_safe = _html_escape(kw)
-        safe = re.sub(rf"({re.escape(kw_safe)})", r"<b>\1</b>", safe)
-    return safe
+    pat = _highlighter(tuple(sorted({k for k in kws if k.strip()})))
+    if pat is None:
+        return _html_escape(text)
+    # single pass over the raw text; escaping per piece keeps keywords from
+    # ever matching inside entities or earlier <b> tags
+    out: List[str] = []
+    pos = 0
+    for m in pat.finditer(text):
+        out.append(_html_escape(text[pos:m.start()]))
+        out.append(f"<b>{_html_escape(m.group())}</b>")
+        pos = m.end()
+    out.append(_html_escape(text[pos:]))
+    return "".join(out)
 
 
 def _chips(keywords: List[str]) -> str:
@@ -35,20 +53,8 @@ def _chips(keywords: List[str]) -> str:
     return "\n".join(f"📌 {_html_escape(k)}" for k in items)
 
 
-def _extract_hour_range_display(title: str) -> Optional[str]:
-    """Return '۹ تا ۱۱' (or Latin digits) after 'ساعت' if present, else None."""
-    m = re.search(r"ساعت\s*([0-9۰-۹]{1,2}\s*تا\s*[0-9۰-۹]{1,2})", title)
-    return m.group(1).strip() if m else None
-
-
-def sort_sections(sections: List[Tuple[str, List[str]]]) -> List[Tuple[str, List[str]]]:
-    with_keys = []
-    for s in sections:
-        title, body = s
-        hour = parse_start_hour_from_title(title)
-        with_keys.append((999 if hour is None else hour, title, body))
-    with_keys.sort(key=lambda x: x[0])
-    return [(t, b) for _, t, b in with_keys]
+def sort_sections(sections: List[Section]) -> List[Section]:
+    return sorted(sections, key=lambda s: 999 if s.start_hour is None else s.start_hour)
 
 
 def format_section_keywords(
@@ -69,12 +75,25 @@ def format_section_keywords(
     return f"⚡ <b>{title_h}</b>\n\n" f"{chips}\n\n" + "\n".join(footer)
 
 
-async def send_long_message(
-    client: TelegramClient, chat_id: int, text: str, chunk_size: int = 3500
-):
+def match_sections(
+    sections: List[Section], keywords: List[str]
+) -> List[Tuple[int, List[str]]]:
+    """Plain per-section scan for a single chat's keywords (used by /check, /addkw)."""
+    kw_orig = [k for k in keywords if k.strip()]
+    kw_norm = [normalize_for_match(k) for k in kw_orig]
+    out: List[Tuple[int, List[str]]] = []
+    for idx, sec in enumerate(sections):
+        text_norm = sec.text_norm
+        matched = [kw_orig[i] for i, k in enumerate(kw_norm) if k and (k in text_norm)]
+        if matched:
+            out.append((idx, matched))
+    return out
+
+
+def split_message(text: str, chunk_size: int = 3500) -> List[str]:
+    """Split on line boundaries into Telegram-sized parts, numbered when more than one."""
     if len(text) <= chunk_size:
-        await client.send_message(chat_id, text, parse_mode="html")
-        return
+        return [text]
     buf, total, chunks = [], 0, []
     for line in text.split("\n"):
         add = len(line) + 1
@@ -87,59 +106,91 @@ async def send_long_message(
             total += add
     if buf:
         chunks.append("\n".join(buf))
+    out = []
     for i, ch in enumerate(chunks, 1):
         suffix = f"\n(بخش پیام {i}/{len(chunks)})" if len(chunks) > 1 else ""
-        await client.send_message(chat_id, ch + suffix, parse_mode="html")
+        out.append(ch + suffix)
+    return out
 
 
-async def send_matching_sections(
-    client: TelegramClient,
-    chat_id: int,
-    last_update_key: str,
-    last_update_display: str,
-    sections: List[Tuple[str, List[str]]],
-    keywords: List[str],
-    force_send: bool = False,
-    ann_display: Optional[str] = None,
-) -> int:
+class RenderCache:
     """
-    Batched: collect ALL matched sections and send them as ONE Telegram message.
-    Returns number of matched sections included.
+    Rendered output shared by every chat of one crawled page: section
+    fragments keyed by (section hash, matched keyword set), whole messages
+    keyed by their block list, and the chunks of each message. Each kind
+    holds at most `max_entries` (oldest dropped first). One is created per
+    crawl and dropped with it; `clear()` releases everything early.
     """
-    kw_orig = [k for k in keywords if k.strip()]
-    kw_lower = [k.strip().lower() for k in kw_orig]
-
-    matched_blocks = (
-        []
-    )  # (section_hash, hour_range, matched_keywords, raw_title, raw_body)
-    total_matched = 0
-
-    for title, body in sections:
-        # normalized text for matching (emoji-free, lowercased)
-        section_text_norm = normalize_for_match(title + "\n" + "\n".join(body))
-        matched_idx = [
-            idx for idx, k in enumerate(kw_lower) if k and (k in section_text_norm)
-        ]
-        if not matched_idx:
-            continue
 
-        matched_keywords = [kw_orig[idx] for idx in matched_idx]
-        sh = hashlib.sha256(
-            (title + "\n" + "\n".join(body)).encode("utf-8", "ignore")
-        ).hexdigest()[:24]
+    def __init__(self, max_entries: int = RENDER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._fragments: Dict[Hashable, str] = {}
+        self._messages: Dict[Hashable, str] = {}
+        self._chunks: Dict[Hashable, List[str]] = {}
 
-        if (not force_send) and has_sent(chat_id, last_update_key, sh):
-            log.debug("skip sent | chat=%s lu=%s hash=%s", chat_id, last_update_key, sh)
-            continue
+    def _get(self, kind: str, store: Dict, key: Hashable, build):
+        val = store.get(key)
+        if val is not None:
+            metrics.RENDER_CACHE.inc(kind=kind, result="hit")
+            return val
+        metrics.RENDER_CACHE.inc(kind=kind, result="miss")
+        val = build()
+        if len(store) >= self.max_entries:
+            del store[next(iter(store))]
+        store[key] = val
+        return val
 
-        hr = _extract_hour_range_display(title)  # e.g. '۹ تا ۱۱'
-        matched_blocks.append((sh, hr, matched_keywords, title, body))
-        total_matched += 1
+    def fragment(self, sh: str, hr: Optional[str], kws: List[str]) -> str:
+        return self._get("fragment", self._fragments, (sh, tuple(kws)),
+                         lambda: _render_block(hr, kws))
+
+    def message(self, matched_blocks, ann_display: Optional[str]) -> str:
+        key = (ann_display, tuple((b[0], tuple(b[2])) for b in matched_blocks))
+        return self._get("message", self._messages, key,
+                         lambda: build_message(matched_blocks, ann_display, cache=self))
+
+    def chunks(self, text: str, chunk_size: int = 3500) -> List[str]:
+        return self._get("chunks", self._chunks, (text, chunk_size),
+                         lambda: split_message(text, chunk_size))
+
+    def clear(self):
+        self._fragments.clear()
+        self._messages.clear()
+        self._chunks.clear()
+
+
+async def send_long_message(
+    client: TelegramClient, chat_id: int, text: str, chunk_size: int = 3500, limiter=None,
+    cache: Optional[RenderCache] = None,
+):
+    """`limiter` (dispatcher.RateLimiter) is awaited before every Telegram send."""
+    parts = cache.chunks(text, chunk_size) if cache is not None else split_message(text, chunk_size)
+    for ch in parts:
+        await send_part(client, chat_id, ch, limiter=limiter)
+
+
+async def send_part(client: TelegramClient, chat_id: int, text: str, limiter=None):
+    """One Telegram send_message (HTML), rate-limited and recorded in metrics."""
+    if limiter is not None:
+        await limiter.acquire(chat_id)
+    t0 = time.perf_counter()
+    try:
+        await client.send_message(chat_id, text, parse_mode="html")
+    except Exception:
+        metrics.SENDS.inc(result="error")
+        raise
+    metrics.SEND_SECONDS.observe(time.perf_counter() - t0)
+    metrics.SENDS.inc(result="ok")
 
-    if not matched_blocks:
-        return 0
 
-    # ---- Build ONE neat message ----
+def _render_block(hr: Optional[str], kws: List[str]) -> str:
+    # time + keywords (each as 📌 on new line)
+    return f"⏰ {hr if hr else '—'}\n{_chips(kws)}"
+
+
+def build_message(matched_blocks, ann_display: Optional[str] = None,
+                  cache: Optional[RenderCache] = None) -> str:
+    """One neat message from (section_hash, hour_range, matched_keywords, title, body) blocks."""
     parts: List[str] = []
     # Constant header (per your example)
     parts.append("⚡️ قطعی احتمالی برق")
@@ -148,29 +199,87 @@ async def send_matching_sections(
     parts.append("")  # blank line
 
     # Each matched section: time + keywords (each as 📌 on new line)
-    for _sh, hr, kws, _title, _body in matched_blocks:
-        parts.append(f"⏰ {hr if hr else '—'}")
-        parts.append(_chips(kws))  # your multi-line chips
+    for sh, hr, kws, _title, _body in matched_blocks:
+        parts.append(cache.fragment(sh, hr, kws) if cache is not None else _render_block(hr, kws))
         parts.append("")  # blank line between sections
 
     # (Optional) If you want to show the crawl timestamp at bottom, uncomment:
     # parts.append(f"⏰ بروزرسانی: <code>{_html_escape(last_update_display)}</code>")
 
-    message = "\n".join(parts).rstrip()
-
-    # Send once; then mark each included section as sent
-    await send_long_message(client, chat_id, message)
-    for sh, _hr, _kws, title, _body in matched_blocks:
-        try:
-            mark_sent(chat_id, last_update_key, sh, title)
-        except Exception as e:
-            log.warning(
-                "mark_sent failed | chat=%s lu=%s hash=%s err=%s",
-                chat_id,
-                last_update_key,
-                sh,
-                e,
-            )
-
-    log.info("batched send | chat=%s sections=%s", chat_id, total_matched)
+    return "\n".join(parts).rstrip()
+
+
+def collect_blocks(
+    sections: List[Section],
+    matches: List[Tuple[int, List[str]]],
+    already_sent: Optional[Set[str]] = None,
+):
+    """(section_hash, hour_range, matched_keywords, title, body) for every match not in `already_sent`."""
+    blocks = []
+    for idx, matched_keywords in matches:
+        sec = sections[idx]
+        if already_sent and sec.hash in already_sent:
+            log.debug("skip sent | hash=%s", sec.hash)
+            continue
+        blocks.append((sec.hash, sec.hour_range, matched_keywords, sec.title, sec.body))
+    return blocks
+
+
+async def send_matching_sections(
+    client: TelegramClient,
+    chat_id: int,
+    last_update_key: str,
+    last_update_display: str,
+    sections: List[Section],
+    keywords: List[str],
+    force_send: bool = False,
+    ann_display: Optional[str] = None,
+    matches: Optional[List[Tuple[int, List[str]]]] = None,
+    limiter=None,
+    already_sent: Optional[Set[str]] = None,
+    cache: Optional[RenderCache] = None,
+) -> int:
+    """
+    Batched: collect ALL matched sections and send them as ONE Telegram message.
+    `matches` is the precomputed [(section_index, matched_keywords)] for this
+    chat (see matcher.SubscriptionRegistry); when omitted, `keywords` are
+    scanned here. `already_sent` is the set of section hashes this chat got
+    for `last_update_key`; when omitted it is fetched with one query.
+    `cache` (a RenderCache) shares rendered fragments and messages with
+    the other chats of the same crawl.
+    Returns number of matched sections included.
+    """
+    if matches is None:
+        matches = match_sections(sections, keywords)
+    if not force_send and already_sent is None:
+        already_sent = await db.sent_hashes(chat_id, last_update_key)
+
+    matched_blocks = collect_blocks(sections, matches, None if force_send else already_sent)
+    total_matched = len(matched_blocks)
+
+    if not matched_blocks:
+        return 0
+
+    if cache is not None:
+        message = cache.message(matched_blocks, ann_display)
+    else:
+        message = build_message(matched_blocks, ann_display)
+
+    # Send once; then mark every included section as sent in one statement
+    await send_long_message(client, chat_id, message, limiter=limiter, cache=cache)
+    try:
+        await db.mark_sent_many(
+            [(chat_id, last_update_key, sh, title) for sh, _hr, _kws, title, _body in matched_blocks]
+        )
+    except Exception as e:
+        log.warning(
+            "mark_sent failed | chat=%s lu=%s sections=%s err=%s",
+            chat_id,
+            last_update_key,
+            len(matched_blocks),
+            e,
+        )
+
+    log.info("batched send | chat=%s sections=%s", chat_id, total_matched,
+             extra={"chat_id": chat_id, "update_key": last_update_key})
     return total_matched
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import time
+from typing import Iterable, List, Set, Tuple
+
+from telethon import errors
+
+import db
+import metrics
+from config import (
+    OUTBOX_BATCH,
+    OUTBOX_POLL_SEC,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_BASE_SEC,
+    OUTBOX_RETRY_MAX_SEC,
+)
+from dispatcher import dispatcher
+from notifier import send_part
+
+log = logging.getLogger("outbox")
+
+# the bot can't write to these chats; retrying won't help
+_PERMANENT_ERRORS = (
+    errors.ChatWriteForbiddenError,
+    errors.UserIsBlockedError,
+    errors.ChannelPrivateError,
+    errors.PeerIdInvalidError,
+)
+
+# (chat_id, last_update, message parts, [(section_hash, title)], priority)
+OutboxItem = Tuple[int, str, List[str], List[Tuple[str, str]], int]
+
+
+def idem_key(chat_id: int, last_update: str, hashes: Iterable[str]) -> str:
+    """Same chat, update key and section set -> same key, so re-enqueueing is a no-op."""
+    digest = hashlib.sha1("\n".join(sorted(hashes)).encode("utf-8")).hexdigest()[:16]
+    return f"{chat_id}:{last_update}:{digest}"
+
+
+class _Entry:
+    __slots__ = ("id", "chat_id", "last_update", "parts", "sections", "parts_sent", "attempts")
+
+    def __init__(self, row: db.OutboxRow):
+        self.id, self.chat_id, self.last_update, parts, sections, _prio, self.parts_sent, self.attempts = row
+        self.parts: List[str] = json.loads(parts)
+        self.sections: List[Tuple[str, str]] = [tuple(s) for s in json.loads(sections)]
+
+
+class Outbox:
+    """
+    SQLite-backed delivery queue. The crawl cycle enqueues rendered
+    messages in bulk; `run()` claims due rows and hands them to the
+    dispatcher's worker pool (rate limiter and FloodWait handling included).
+    Progress is stored per message part and a delivered row is removed in
+    the same transaction that marks its sections sent, so a restart resumes
+    where delivery stopped. Failures are retried with exponential backoff
+    until OUTBOX_MAX_ATTEMPTS, then the row is kept as 'dead'.
+    """
+
+    def __init__(
+        self,
+        batch: int = OUTBOX_BATCH,
+        poll: float = OUTBOX_POLL_SEC,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        retry_base: float = OUTBOX_RETRY_BASE_SEC,
+        retry_max: float = OUTBOX_RETRY_MAX_SEC,
+        shard: db.Shard = None,
+    ):
+        self.batch = batch
+        self.poll = poll
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        # a shard worker only claims rows of its own chats
+        self.shard = shard
+        self._inflight: Set[int] = set()
+        self._wake = asyncio.Event()
+
+    async def enqueue(self, items: List[OutboxItem]) -> int:
+        """Queue messages durably (committed on return). Returns how many were new."""
+        rows = [
+            (idem_key(chat_id, lu, [sh for sh, _t in secs]), chat_id, lu,
+             json.dumps(parts, ensure_ascii=False), json.dumps(secs, ensure_ascii=False), prio)
+            for chat_id, lu, parts, secs, prio in items
+        ]
+        n = await db.outbox_enqueue_many(rows)
+        if n:
+            metrics.OUTBOX_ENQUEUED.inc(n)
+            self._wake.set()
+        log.info("enqueued | messages=%s new=%s", len(rows), n)
+        return n
+
+    async def run(self, client):
+        log.info("outbox worker started")
+        while True:
+            delay = self.poll
+            try:
+                await self._fill(client)
+                await self._report()
+                next_at = await db.outbox_next_at(self.shard)
+                if next_at is not None:
+                    delay = min(delay, max(0.0, next_at - time.time()))
+            except Exception as e:
+                log.exception("outbox loop error: %s", e)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fill(self, client):
+        room = self.batch - len(self._inflight)
+        if room <= 0:
+            return
+        for row in await db.outbox_due(int(time.time()), room, exclude=self._inflight, shard=self.shard):
+            entry = _Entry(row)
+            self._inflight.add(entry.id)
+            fut = dispatcher.submit(entry.chat_id, functools.partial(self._deliver, client, entry),
+                                    priority=row[5])
+            asyncio.create_task(self._track(entry, fut))
+
+    async def _deliver(self, client, entry: _Entry) -> int:
+        # resumes after the last part known to be sent (also after a FloodWait requeue)
+        for i in range(entry.parts_sent, len(entry.parts)):
+            await send_part(client, entry.chat_id, entry.parts[i], limiter=dispatcher.limiter)
+            entry.parts_sent = i + 1
+            await db.outbox_progress(entry.id, entry.parts_sent)
+        await db.outbox_complete(
+            entry.id, [(entry.chat_id, entry.last_update, sh, title) for sh, title in entry.sections]
+        )
+        return len(entry.sections)
+
+    async def _track(self, entry: _Entry, fut: asyncio.Future):
+        try:
+            sent = await fut
+            metrics.OUTBOX_DELIVERIES.inc(result="ok")
+            log.info("delivered | chat=%s sections=%s", entry.chat_id, sent,
+                     extra={"chat_id": entry.chat_id, "update_key": entry.last_update})
+        except Exception as e:
+            await self._failed(entry, e)
+        finally:
+            self._inflight.discard(entry.id)
+            self._wake.set()
+
+    async def _failed(self, entry: _Entry, e: Exception):
+        attempts = entry.attempts + 1
+        err = f"{type(e).__name__}: {e}"
+        if isinstance(e, _PERMANENT_ERRORS) or attempts >= self.max_attempts:
+            metrics.OUTBOX_DELIVERIES.inc(result="dead")
+            log.error("giving up | chat=%s id=%s attempts=%s err=%s", entry.chat_id, entry.id, attempts, err)
+            await db.outbox_retry(entry.id, attempts, None, err)
+            return
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        if isinstance(e, errors.FloodWaitError):
+            delay = max(delay, e.seconds)
+        metrics.OUTBOX_DELIVERIES.inc(result="retry")
+        log.warning("retry in %.0fs | chat=%s id=%s attempts=%s err=%s",
+                    delay, entry.chat_id, entry.id, attempts, err,
+                    extra={"chat_id": entry.chat_id, "update_key": entry.last_update})
+        await db.outbox_retry(entry.id, attempts, int(time.time() + delay), err)
+
+    async def _report(self):
+        pending, oldest, dead = await db.outbox_stats(self.shard)
+        metrics.OUTBOX_DEPTH.set(pending)
+        metrics.OUTBOX_OLDEST_AGE.set(time.time() - oldest if oldest else 0)
+        metrics.OUTBOX_DEAD.set(dead)
+
+
+outbox = Outbox()
@@ -0,0 +1,152 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Optional, Tuple, TypeVar
+
+from config import PROFILE_DIR, PROFILE_TOP_N
+from crawler import crawl_cached
+from matcher import registry
+from notifier import RenderCache, collect_blocks
+
+log = logging.getLogger("profiling")
+
+T = TypeVar("T")
+# (summary text, path of the full stats file)
+Report = Tuple[str, str]
+
+# Nothing here runs unless an admin asked for it: the crawler only checks
+# `_next` once per source crawl, and profilers are started and stopped per request.
+_busy = False
+_next: Optional["_Request"] = None
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+class _Request:
+    __slots__ = ("kind", "future")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    async def run(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run `fn()` (one source crawl) under the requested profiler."""
+        if _busy:
+            # a dry run got there first; the crawl itself must still run
+            self.future.set_exception(ProfilerBusy("a profile is already running"))
+            return await fn()
+        try:
+            result, report = await profile(self.kind, fn)
+        except Exception as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+            raise
+        if not self.future.done():
+            self.future.set_result(report)
+        return result
+
+
+def request_next(kind: str) -> asyncio.Future:
+    """Profile the next source crawl of periodic_crawler; the future resolves to its Report."""
+    global _next
+    if _busy or _next is not None:
+        raise ProfilerBusy("a profile is already running or scheduled")
+    _next = _Request(kind)
+    return _next.future
+
+
+def take_request() -> Optional[_Request]:
+    global _next
+    req, _next = _next, None
+    return req
+
+
+def _path(kind: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    ext = "prof" if kind == "cpu" else "tracemalloc"
+    return os.path.join(PROFILE_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+
+async def profile(kind: str, fn: Callable[[], Awaitable[T]]) -> Tuple[T, Report]:
+    """
+    Await `fn()` under cProfile (kind="cpu") or tracemalloc (kind="mem").
+    Everything the event loop runs meanwhile is included, not only `fn`.
+    cProfile only sees the loop thread: parsing and SQLite, which run in
+    executors, show up as time spent waiting on futures.
+    """
+    global _busy
+    if _busy:
+        raise ProfilerBusy("a profile is already running")
+    _busy = True
+    try:
+        if kind == "cpu":
+            return await _profile_cpu(fn)
+        return await _profile_mem(fn)
+    finally:
+        _busy = False
+
+
+async def _profile_cpu(fn):
+    prof = cProfile.Profile()
+    t0 = time.perf_counter()
+    prof.enable()
+    try:
+        result = await fn()
+    finally:
+        prof.disable()
+    took = time.perf_counter() - t0
+    path = _path("cpu")
+    prof.dump_stats(path)
+    out = io.StringIO()
+    stats = pstats.Stats(prof, stream=out)
+    stats.strip_dirs().sort_stats("tottime").print_stats(PROFILE_TOP_N)
+    # drop pstats' preamble; keep the table
+    lines = out.getvalue().splitlines()
+    table = [l.rstrip() for l in lines if l.strip()][1:]
+    text = f"cProfile: {took:.2f}s wall, top {PROFILE_TOP_N} by own time\n" + "\n".join(table)
+    log.info("cpu profile written | path=%s took=%.2fs", path, took)
+    return result, (text, path)
+
+
+async def _profile_mem(fn):
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(10)
+    try:
+        before = tracemalloc.take_snapshot()
+        result = await fn()
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    path = _path("mem")
+    after.dump(path)
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    growth = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    lines = [f"tracemalloc: current={current / 1e6:.1f} MB peak={peak / 1e6:.1f} MB; "
+             f"top {PROFILE_TOP_N} allocation sites by growth during the run"]
+    lines += [str(s) for s in growth[:PROFILE_TOP_N]]
+    log.info("memory snapshot written | path=%s", path)
+    return result, ("\n".join(lines), path)
+
+
+async def dry_run_cycle() -> int:
+    """crawl + match + render for every source, without enqueueing or sending. Returns messages rendered."""
+    cache = RenderCache()
+    rendered = 0
+    for url in registry.sources():
+        _lu, sections, ann_display, _key = await crawl_cached(url, max_age=0)
+        for _chat_id, chat_hits in registry.match_sections(url, sections).items():
+            blocks = collect_blocks(sections, chat_hits)
+            if blocks:
+                cache.chunks(cache.message(blocks, ann_display))
+                rendered += 1
+    return rendered
@@ -0,0 +1,145 @@
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+
+import db
+from config import (
+    DEFAULT_URL,
+    CRAWL_INTERVAL_MIN,
+    CRAWL_MIN_INTERVAL_SEC,
+    CRAWL_MAX_INTERVAL_SEC,
+    SCHED_HISTORY_DAYS,
+    SCHED_JITTER,
+)
+
+log = logging.getLogger("scheduler")
+
+SLOT_SEC = 15 * 60
+SLOTS = 86400 // SLOT_SEC
+# a change within +/- this many slots of "now" counts as "near"
+NEAR_SLOTS = 2
+# below this many observed changes the profile isn't trusted; use the base interval
+MIN_SAMPLES = 5
+
+
+def _slot(ts: float) -> int:
+    return int(ts % 86400) // SLOT_SEC
+
+
+class AdaptiveScheduler:
+    """
+    Picks the delay before the next crawl from a time-of-day profile of
+    when the portal's update key actually changed (15-minute slots over
+    the last SCHED_HISTORY_DAYS). Polls fast around typical publication
+    times, slowly elsewhere, backs off exponentially on fetch failures,
+    and always stays within [CRAWL_MIN_INTERVAL_SEC, CRAWL_MAX_INTERVAL_SEC].
+    One per source, see SourceSchedulers.
+    """
+
+    def __init__(
+        self,
+        base: float = CRAWL_INTERVAL_MIN * 60,
+        min_delay: float = CRAWL_MIN_INTERVAL_SEC,
+        max_delay: float = CRAWL_MAX_INTERVAL_SEC,
+        jitter: float = SCHED_JITTER,
+    ):
+        self.base = base
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._counts: List[int] = [0] * SLOTS
+        self._total = 0
+        self._failures = 0
+
+    def _add(self, ts: float):
+        self._counts[_slot(ts)] += 1
+        self._total += 1
+
+    def record_success(self):
+        self._failures = 0
+
+    def record_failure(self):
+        self._failures += 1
+
+    def _clamp(self, v: float) -> float:
+        return max(self.min_delay, min(self.max_delay, v))
+
+    def _profile_delay(self, now: float) -> float:
+        if self._total < MIN_SAMPLES:
+            return self.base
+        s = _slot(now)
+        near = sum(self._counts[(s + d) % SLOTS] for d in range(-NEAR_SLOTS, NEAR_SLOTS + 1))
+        # how much likelier a change is near now than under a uniform profile
+        ratio = (near / self._total) / ((2 * NEAR_SLOTS + 1) / SLOTS)
+        delay = self.max_delay if ratio <= 0 else self.base / ratio
+        # don't sleep through the approach to the next slot where changes happen
+        return min(delay, self._until_next_near(now))
+
+    def _until_next_near(self, now: float) -> float:
+        s = _slot(now)
+        for ahead in range(NEAR_SLOTS + 1, SLOTS):
+            if self._counts[(s + ahead) % SLOTS]:
+                slot_start = now - (now % SLOT_SEC) + ahead * SLOT_SEC
+                return max(0.0, slot_start - NEAR_SLOTS * SLOT_SEC - now)
+        return self.max_delay
+
+    def next_delay(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        if self._failures:
+            delay = self.base * (2 ** min(self._failures - 1, 10))
+            # on failure, never poll faster than the base interval
+            delay = max(self.base, min(delay, self.max_delay))
+        else:
+            delay = self._profile_delay(now)
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        delay = self._clamp(delay)
+        log.debug("next crawl in %.0fs (failures=%s)", delay, self._failures)
+        return delay
+
+
+def _stored_url(url: str) -> str:
+    # update_changes.url follows chats.url: '' is the default source
+    return "" if url == DEFAULT_URL else url
+
+
+class SourceSchedulers:
+    """
+    An AdaptiveScheduler per source URL, created on first use with the
+    settings below, so every source has its own change profile and its
+    own failure backoff: a dead district page never slows the others.
+    """
+
+    def __init__(
+        self,
+        base: float = CRAWL_INTERVAL_MIN * 60,
+        min_delay: float = CRAWL_MIN_INTERVAL_SEC,
+        max_delay: float = CRAWL_MAX_INTERVAL_SEC,
+        jitter: float = SCHED_JITTER,
+    ):
+        self.base = base
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._by_url: Dict[str, AdaptiveScheduler] = {}
+
+    def source(self, url: str) -> AdaptiveScheduler:
+        sched = self._by_url.get(url)
+        if sched is None:
+            sched = self._by_url[url] = AdaptiveScheduler(self.base, self.min_delay, self.max_delay, self.jitter)
+        return sched
+
+    async def load(self):
+        since = int(time.time()) - SCHED_HISTORY_DAYS * 86400
+        rows = await db.list_update_changes(since)
+        for url, ts in rows:
+            self.source(url or DEFAULT_URL)._add(ts)
+        log.info("change profiles loaded | sources=%s samples=%s", len(self._by_url), len(rows))
+
+    async def record_change(self, url: str, key: str, ts: Optional[float] = None):
+        ts = time.time() if ts is None else ts
+        self.source(url)._add(ts)
+        await db.record_update_change(key, int(ts), _stored_url(url))
+
+
+scheduler = SourceSchedulers()
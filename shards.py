@@ -0,0 +1,202 @@
+"""
+Sharded fan-out for very large chat counts.
+
+With SHARD_WORKERS=N the main process still crawls every source once per
+cycle and handles commands and broadcasts, but instead of matching it
+publishes each new page's parsed sections to the `published` table. N
+worker processes each own the chats with chat_id % N == index: they poll
+that table, match the page against their own subscriptions, dedup, render
+and deliver through their own outbox with 1/(N+1) of the bot's send rate
+(the main process keeps a share for broadcasts and command replies), so
+matching, rendering and SQLite encoding run on N cores instead of one.
+
+Everything goes through the bot's SQLite file (WAL; a writer waits up to
+DB_BUSY_TIMEOUT_SEC for another process's commit). Each worker logs in
+with its own Telethon session that receives no updates, and writes its own
+log file (bot-shard<i>.log) and metrics port (METRICS_PORT + 1 + i).
+With SHARD_WORKERS=0 main.py calls fan_out() itself for all chats.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from typing import Dict, List, Optional
+
+from telethon import TelegramClient
+
+import db
+import metrics
+from config import API_ID, API_HASH, BOT_TOKEN, PROXY, METRICS_HOST, METRICS_PORT, SHARD_POLL_SEC
+from crawler import Section
+from dispatcher import dispatcher
+from logging_config import setup_logging, stop_logging
+from matcher import SourceRegistry
+from notifier import RenderCache, collect_blocks
+from outbox import Outbox
+
+log = logging.getLogger("shards")
+
+# workers start from a fresh interpreter: forking a process that already runs
+# an event loop, the DB thread and the log listener is not safe
+_ctx = multiprocessing.get_context("spawn")
+
+# a published page whose fan-out keeps failing is retried with exponential
+# backoff (SHARD_POLL_SEC * 2**n, capped), then skipped
+_MAX_ATTEMPTS = 5
+_RETRY_MAX_SEC = 300
+
+
+def _chat_priority(sections, chat_hits) -> int:
+    """Earliest outage start hour among the chat's matches; sooner outages go first."""
+    hours = [sections[idx].start_hour for idx, _kws in chat_hits]
+    return min((h for h in hours if h is not None), default=99)
+
+
+async def fan_out(reg: SourceRegistry, url: str, base_key: str, sections: List[Section],
+                  ann_display: Optional[str], ob: Outbox, cache: RenderCache,
+                  shard: db.Shard = None) -> int:
+    """Match one parsed page against the chats in `reg` and enqueue their messages. Returns messages queued."""
+    # one automaton pass per section covers every keyword of this source's chats
+    with metrics.MATCH_SECONDS.time():
+        hits = reg.match_sections(url, sections)
+    # dedup state for every chat in one query
+    sent_map = await db.sent_hashes_by_chat(base_key, shard)
+    items = []
+    for chat_id, chat_hits in hits.items():
+        blocks = collect_blocks(sections, chat_hits, sent_map.get(chat_id))
+        if not blocks:
+            continue
+        message = cache.message(blocks, ann_display)
+        items.append((chat_id, base_key, cache.chunks(message),
+                      [(sh, title) for sh, _hr, _kws, title, _body in blocks],
+                      _chat_priority(sections, chat_hits)))
+    await ob.enqueue(items)
+    return len(items)
+
+
+async def publish(url: str, base_key: str, sections: List[Section], ann_display: Optional[str]):
+    """Hand a new page to the shard workers (committed on return)."""
+    payload = json.dumps([(s.title, s.body) for s in sections], ensure_ascii=False)
+    row_id = await db.publish(url, base_key, ann_display, payload)
+    log.info("published | id=%s url=%s sections=%s", row_id, url, len(sections),
+             extra={"update_key": base_key})
+
+
+def _sections(payload: str) -> List[Section]:
+    return [Section(title, body) for title, body in json.loads(payload)]
+
+
+async def consume(index: int, count: int, ob: Outbox, poll: float = SHARD_POLL_SEC):
+    """Fan out every page published after this shard's cursor to the shard's chats."""
+    shard = (index, count)
+    setting = f"shard_cursor:{index}/{count}"
+    cursor = await db.get_setting(setting)
+    # published row id -> failed fan-outs; retried with backoff, then skipped
+    failures: Dict[int, int] = {}
+    while True:
+        delay = poll
+        try:
+            # a new shard layout starts at the current page of each source, like a fresh install
+            rows = await (db.published_latest() if cursor is None else db.published_since(int(cursor)))
+            if rows:
+                # subscriptions are edited by the main process's commands; reload per batch
+                reg = SourceRegistry()
+                await reg.load(shard)
+            for row_id, url, base_key, ann_display, payload in rows:
+                started = time.perf_counter()
+                try:
+                    n = await fan_out(reg, url, base_key, _sections(payload), ann_display, ob,
+                                      RenderCache(), shard)
+                except Exception as e:
+                    attempts = failures.get(row_id, 0) + 1
+                    if attempts < _MAX_ATTEMPTS:
+                        failures[row_id] = attempts
+                        delay = min(_RETRY_MAX_SEC, poll * 2 ** attempts)
+                        log.warning("shard %s/%s fan-out failed, retry in %.1fs | id=%s attempts=%s: %s",
+                                    index, count, delay, row_id, attempts, e, exc_info=True)
+                        break
+                    # don't let one bad page block every later one
+                    failures.pop(row_id, None)
+                    metrics.SHARD_FANOUT_SKIPPED.inc()
+                    log.error("shard %s/%s giving up on published page | id=%s url=%s attempts=%s: %s",
+                              index, count, row_id, url, attempts, e, extra={"update_key": base_key})
+                    n = 0
+                failures.pop(row_id, None)
+                # as in main: the cursor moves once the messages are durably queued,
+                # a crash in between re-enqueues them and the outbox ignores them
+                cursor = str(row_id)
+                await db.set_setting(setting, cursor)
+                took = time.perf_counter() - started
+                log.info("shard %s/%s fanned out | id=%s url=%s messages=%s took=%.2fs",
+                         index, count, row_id, url, n, took,
+                         extra={"update_key": base_key, "stage": "fan_out", "duration_ms": round(took * 1000, 1)})
+            else:
+                if rows:
+                    continue  # a full batch went through; look for more right away
+        except Exception as e:
+            log.exception("shard %s/%s fan-out error: %s", index, count, e)
+        await asyncio.sleep(delay)
+
+
+async def serve(index: int, count: int, client):
+    """Deliver for shard `index` of `count` with an already connected client."""
+    # the main process keeps one share for broadcasts and command replies
+    dispatcher.limiter.split(count + 1)
+    ob = Outbox(shard=(index, count))
+    await asyncio.gather(ob.run(client), consume(index, count, ob))
+
+
+async def _worker(index: int, count: int):
+    setup_logging(f"bot-shard{index}.log")
+    await db.init()
+    client = TelegramClient(f"qepd_bot_shard{index}", API_ID, API_HASH, proxy=PROXY, receive_updates=False)
+    await client.start(bot_token=BOT_TOKEN)
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_HOST, METRICS_PORT + 1 + index)
+    log.info("shard worker %s/%s up", index, count)
+    try:
+        await serve(index, count, client)
+    finally:
+        await client.disconnect()
+        await db.close()
+        stop_logging()
+
+
+def _worker_main(index: int, count: int):
+    try:
+        asyncio.run(_worker(index, count))
+    except KeyboardInterrupt:
+        pass
+
+
+class Workers:
+    """The shard worker processes of the main process; one that exits is restarted."""
+
+    def __init__(self, count: int):
+        self.count = count
+        self._procs: List[multiprocessing.Process] = []
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        proc = _ctx.Process(target=_worker_main, args=(index, self.count), name=f"shard-{index}", daemon=True)
+        proc.start()
+        return proc
+
+    def start(self):
+        self._procs = [self._spawn(i) for i in range(self.count)]
+        log.info("started %s shard workers", self.count)
+
+    async def supervise(self, interval: float = 10):
+        while True:
+            await asyncio.sleep(interval)
+            for i, proc in enumerate(self._procs):
+                if not proc.is_alive():
+                    log.error("shard worker %s exited (code %s); restarting", i, proc.exitcode)
+                    self._procs[i] = self._spawn(i)
+
+    def stop(self):
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self._procs:
+            proc.join(timeout=10)
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 from typing import Optional, Tuple
 
 PERSIAN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹", "0123456789")
@@ -40,10 +41,39 @@ def strip_decor_prefix(s: str) -> str:
     return DECOR_PREFIX_RE.sub("", s)
 
 
+def _match_table() -> dict:
+    table = {}
+    # emoji & symbol ranges (same as EMOJI_RE) -> removed
+    for lo, hi in ((0x2600, 0x26FF), (0x2700, 0x27BF), (0x1F300, 0x1FAFF), (0x1F1E6, 0x1F1FF)):
+        table.update(dict.fromkeys(range(lo, hi + 1)))
+    # zero-width / bidi marks, variation selector, tatweel, Arabic diacritics -> removed
+    for ch in "\u200b\u200c\u200d\u200e\u200f\u2066\u2067\u2068\u2069\ufe0f\u0640":
+        table[ord(ch)] = None
+    table.update(dict.fromkeys(range(0x064B, 0x0653)))
+    # Arabic letter forms -> Persian
+    table[ord("ي")] = "ی"
+    table[ord("ى")] = "ی"
+    table[ord("ك")] = "ک"
+    table[0xA0] = " "  # NBSP
+    table.update(PERSIAN_DIGITS)
+    table.update(ARABIC_DIGITS)
+    return table
+
+
+_MATCH_TABLE = _match_table()
+_SPACES_RE = re.compile(r"[ \t]+")
+
+
+@lru_cache(maxsize=4096)
 def normalize_for_match(s: str) -> str:
-    s = clean_text(s)
-    s = strip_emojis(s)
-    return s.lower()
+    """
+    Canonical form for keyword matching, applied identically to section
+    text and keywords: one translate pass (emoji/ZWNJ/bidi/diacritics
+    removed, Arabic ي/ك -> Persian ی/ک, Persian/Arabic digits -> ASCII),
+    one regex pass collapsing spaces, then lower-case.
+    """
+    s = _SPACES_RE.sub(" ", s.translate(_MATCH_TABLE))
+    return s.strip().lower()
 
 
 def parse_start_hour_from_title(title: str) -> Optional[int]:
@@ -61,6 +91,12 @@ def parse_start_hour_from_title(title: str) -> Optional[int]:
         return None
 
 
+def extract_hour_range_display(title: str) -> Optional[str]:
+    """Return '۹ تا ۱۱' (or Latin digits) after 'ساعت' if present, else None."""
+    m = re.search(r"ساعت\s*([0-9۰-۹]{1,2}\s*تا\s*[0-9۰-۹]{1,2})", title)
+    return m.group(1).strip() if m else None
+
+
 # ---- AnnTitle date parsing ----
 JALALI_MONTHS = {
     "فروردین": 1,